@@ -69,7 +69,7 @@ print(sum(items))
 # 1.3 Keepingthe Last N Items
 from collections import deque
 def search(lines, pattern, history=5):
-    previous_line = deque(maxlen=history)
+    previous_lines = deque(maxlen=history)
     for line in lines:
         if pattern in line:
             yield line, previous_lines
@@ -81,8 +81,7 @@ def search(lines, pattern, history=5):
 #            for pline in prevlines:
 #                print(pline, end='')
 #            print(line, end='')
-#
-        print('-'*20)
+#            print('-'*20)
 
 # About deque()
 # Using deque(maxlen=N) creates a fixed-sized queue. When new items are added and
@@ -113,6 +112,160 @@ print(q)
 q.popleft()
 print(q)
 
+# Multi-pattern search over a memory-mapped file (Aho-Corasick)
+# search() tests one pattern per line and copies every line into the deque. For big logs
+# and hundreds of watch terms, build one automaton for all of the patterns and scan the
+# mmap'd file as bytes. Nothing is kept per line: when a match fires, the previous lines
+# are sliced out of the map by walking back over the newline offsets.
+import os
+import re
+import mmap
+
+class AhoCorasick:
+    def __init__(self, patterns):
+        self.patterns = [p.encode() if isinstance(p, str) else bytes(p) for p in patterns]
+        if not self.patterns:
+            raise ValueError('At least one pattern is required')
+        goto = [{}]                 # trie: state -> {byte: next state}
+        out = [set()]               # state -> indexes of the patterns ending there
+        for i, pat in enumerate(self.patterns):
+            if not pat or b'\n' in pat:
+                raise ValueError('Patterns must be non-empty and fit on one line: {!r}'.format(pat))
+            state = 0
+            for byte in pat:
+                nxt = goto[state].get(byte)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][byte] = nxt
+                    goto.append({})
+                    out.append(set())
+                state = nxt
+            out[state].add(i)
+
+        # Breadth-first over the trie: compute the failure links and fold them into a
+        # full 256-way transition table, so scanning is one list lookup per byte.
+        fail = [0] * len(goto)
+        delta = [None] * len(goto)
+        delta[0] = [goto[0].get(byte, 0) for byte in range(256)]
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            f = fail[state]
+            out[state] |= out[f]
+            row = list(delta[f])
+            for byte, nxt in goto[state].items():
+                row[byte] = nxt
+                fail[nxt] = delta[f][byte]
+                queue.append(nxt)
+            delta[state] = row
+        self._delta = delta
+        self._out = [tuple(sorted(o)) for o in out]
+        # From the root state, jump straight to the next byte that can start a pattern
+        self._skip = re.compile(b'[' + b''.join(re.escape(bytes([byte])) for byte in goto[0]) + b']')
+
+    def __repr__(self):
+        return 'AhoCorasick({} patterns, {} states)'.format(len(self.patterns), len(self._delta))
+
+    def match_line(self, line):
+        '''Return the indexes of the patterns found in a bytes line'''
+        delta, out = self._delta, self._out
+        state = 0
+        found = set()
+        for byte in line:
+            state = delta[state][byte]
+            found.update(out[state])
+        return found
+
+def mmap_search(filename, patterns, history=5):
+    ac = patterns if isinstance(patterns, AhoCorasick) else AhoCorasick(patterns)
+    delta, out, skip = ac._delta, ac._out, ac._skip
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            size = len(m)
+            pos = 0
+            state = 0
+            while pos < size:
+                if state == 0:
+                    mo = skip.search(m, pos)
+                    if mo is None:
+                        break
+                    pos = mo.start()
+                # Patterns never contain b'\n', so a newline always sends us back to the root
+                state = delta[state][m[pos]]
+                pos += 1
+                if out[state]:
+                    start = m.rfind(b'\n', 0, pos) + 1
+                    end = m.find(b'\n', pos)
+                    end = size if end < 0 else end + 1
+                    previous_lines = deque()
+                    s = start
+                    while s > 0 and len(previous_lines) < history:
+                        p = m.rfind(b'\n', 0, s - 1) + 1
+                        previous_lines.appendleft(m[p:s])
+                        s = p
+                    yield m[start:end], previous_lines
+                    pos = end          # One report per line, like search()
+                    state = 0
+
+ac = AhoCorasick(['he', 'she', 'his', 'hers'])
+print(ac, [ac.patterns[i] for i in sorted(ac.match_line(b'ushers'))])
+for line, prevlines in mmap_search('somefile.txt', ['hello', 'world']):
+    print(list(prevlines), line)
+
+BENCHMARKS = []                 # (bench function, arguments for a quick run)
+
+def benchmark(**kwargs):
+    def register(func):
+        BENCHMARKS.append((func, kwargs))
+        return func
+    return register
+
+@benchmark(nlines=20000, npatterns=100)
+def bench_search(nlines=200000, npatterns=200, history=5):
+    import random
+    import tempfile
+    import time
+    random.seed(0)
+    levels = ['INFO', 'DEBUG', 'WARN', 'ERROR']
+    patterns = ['user=u{}x'.format(n) for n in random.sample(range(100000), npatterns)]
+    with tempfile.NamedTemporaryFile('w', suffix='.log', delete=False) as f:
+        for n in range(nlines):
+            f.write('{} req={} user=u{}x path=/api/v1/item/{} status=200\n'.format(
+                random.choice(levels), n, random.randrange(100000), random.randrange(1000)))
+        filename = f.name
+    mbytes = os.path.getsize(filename) / 1e6
+
+    def search_any(lines, patterns, history=5):      # search() generalized to many patterns
+        previous_lines = deque(maxlen=history)
+        for line in lines:
+            if any(pattern in line for pattern in patterns):
+                yield line, previous_lines
+            previous_lines.append(line)
+
+    try:
+        start = time.perf_counter()
+        with open(filename) as f:
+            hits_one = len([line for line, prev in search(f, patterns[0], history)])
+        t_one = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with open(filename) as f:
+            hits_any = len([line for line, prev in search_any(f, patterns, history)])
+        t_any = time.perf_counter() - start
+
+        start = time.perf_counter()
+        hits_ac = len([line for line, prev in mmap_search(filename, patterns, history)])
+        t_ac = time.perf_counter() - start
+    finally:
+        os.remove(filename)
+
+    print('{:.1f} MB, {} lines, {} patterns'.format(mbytes, nlines, npatterns))
+    print('search() 1 pattern    : {:8.3f}s {:8.1f} MB/s {} hits'.format(t_one, mbytes / t_one, hits_one))
+    print('search() + any()      : {:8.3f}s {:8.1f} MB/s {} hits'.format(t_any, mbytes / t_any, hits_any))
+    print('mmap_search()         : {:8.3f}s {:8.1f} MB/s {} hits'.format(t_ac, mbytes / t_ac, hits_ac))
+
 
 # 1.4 Finding the Largest or Smallest N Items
 import heapq
@@ -149,6 +302,106 @@ print(heapq.heappop(heap))
 print(heapq.heappop(heap))
 print(heapq.heappop(heap))
 
+# Top-K over portfolios too big for one list
+# nlargest() only ever keeps n items, so it already runs in bounded memory when it is fed
+# a generator instead of a list. For many shard files, run it per shard in a process pool
+# and take nlargest() again over the partial results. When the prices are already a
+# column (a NumPy array or array('d')), skip the per-record key calls altogether:
+# partition() finds the n-th best value in O(len), and only the n winners get sorted.
+import csv
+from itertools import chain, repeat
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def read_portfolio(filename):
+    with open(filename, newline='') as f:
+        rows = csv.reader(f)
+        next(rows)                          # Skip the name,shares,price header
+        for name, shares, price in rows:
+            yield {'name': name, 'shares': int(shares), 'price': float(price)}
+
+def shard_top(filename, n, field='price', largest=True):
+    select = heapq.nlargest if largest else heapq.nsmallest
+    return select(n, read_portfolio(filename), key=itemgetter(field))
+
+def parallel_top(n, filenames, field='price', largest=True, workers=None):
+    select = heapq.nlargest if largest else heapq.nsmallest
+    with ProcessPoolExecutor(workers) as pool:
+        partials = pool.map(shard_top, filenames, repeat(n), repeat(field), repeat(largest))
+        return select(n, chain.from_iterable(partials), key=itemgetter(field))
+
+def column_top(n, values, largest=True):
+    '''Return the indexes of the n largest (or smallest) values, best first'''
+    size = len(values)
+    n = min(n, size)
+    if n <= 0:
+        return []
+    if np is not None:
+        # No -values for largest: that overflows for unsigned ints and -2**63, and fails for bools
+        values = np.asarray(values)
+        if n < size:
+            # Ties at the cut-off go to the lowest indexes, as they do in nlargest()
+            cut = np.partition(values, size - n if largest else n - 1)[size - n if largest else n - 1]
+            better = np.flatnonzero(values > cut if largest else values < cut)
+            part = np.concatenate((better, np.flatnonzero(values == cut)[:n - len(better)]))
+        else:
+            part = np.arange(size)
+        if largest:
+            # Ascending by (value, -index), reversed: best value first, lowest index first
+            return part[np.lexsort((-part, values[part]))[::-1]].tolist()
+        return part[np.lexsort((part, values[part]))].tolist()
+    # Without NumPy, compare (value, index) tuples in C instead of calling a key function
+    if largest:
+        return [-i for _, i in heapq.nlargest(n, zip(values, range(0, -size, -1)))]
+    return [i for _, i in heapq.nsmallest(n, zip(values, range(size)))]
+
+from array import array
+prices = array('d', (s['price'] for s in portfolio))
+print('column_top:', [portfolio[i]['name'] for i in column_top(3, prices)],
+      [portfolio[i]['name'] for i in column_top(3, prices, largest=False)])
+
+@benchmark(rows=200000, shards=4)
+def bench_top(rows=1000000, shards=8, n=10):
+    import random
+    import tempfile
+    import time
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as dirname:
+        filenames = []
+        records = []
+        for shard in range(shards):
+            filename = os.path.join(dirname, 'shard{}.csv'.format(shard))
+            with open(filename, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['name', 'shares', 'price'])
+                for i in range(rows // shards):
+                    rec = ['S{}_{}'.format(shard, i), random.randrange(1, 1000), round(random.uniform(1, 1000), 2)]
+                    writer.writerow(rec)
+                    records.append({'name': rec[0], 'shares': rec[1], 'price': rec[2]})
+            filenames.append(filename)
+        total = len(records)
+
+        def report(name, func):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            print('{:32} {:>12,.0f} rows/s'.format(name, total / elapsed))
+            return result
+
+        expected = report('nlargest(key=lambda) in memory',
+                          lambda: heapq.nlargest(n, records, key=lambda s: s['price']))
+        report('shard_top() streaming, serial',
+               lambda: heapq.nlargest(n, chain.from_iterable(shard_top(f, n) for f in filenames),
+                                      key=itemgetter('price')))
+        report('parallel_top() process pool', lambda: parallel_top(n, filenames))
+        prices = array('d', (r['price'] for r in records))
+        top = report('column_top() ' + ('numpy' if np else 'array'), lambda: column_top(n, prices))
+        print([records[i]['price'] for i in top] == [r['price'] for r in expected])
+
 
 # 1.5 Implementing a Priority Queue
 import heapq
@@ -207,6 +460,822 @@ c = (1, 2, Item('grok'))
 print(a < b)
 print(a < c)
 
+# Indexed priority queue: update_priority(), remove() and push_many()
+# heapq can't find an entry inside the heap, so the usual way to cancel a job is to mark
+# it dead and skip it on pop() (lazy deletion). Here every entry remembers its position
+# in the heap, so push() hands back a handle and the entry can be re-prioritized or
+# removed in O(log n). Each entry is a list [(-priority, index), item, position].
+#
+# This is not faster than lazy deletion: keeping the positions up to date means sifting
+# in Python instead of inside heapq's C code, and bench_priority_queue() shows it slower
+# at push, update and pop alike. What it buys is that cancelled and re-prioritized
+# entries leave the heap at once, so the heap holds only live entries and pop() never
+# wades through dead ones. Use it when most jobs are cancelled or memory is tight.
+
+class IndexedPriorityQueue:
+    def __init__(self):
+        self._heap = []
+        self._index = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, item, priority):
+        entry = [(-priority, self._index), item, len(self._heap)]
+        self._index += 1
+        self._heap.append(entry)
+        self._siftup(entry[2])
+        return entry
+
+    def push_many(self, items):
+        '''Push (item, priority) pairs and heapify once; returns the handles'''
+        heap = self._heap
+        index = self._index
+        handles = [[(-priority, index + n), item, 0] for n, (item, priority) in enumerate(items)]
+        self._index += len(handles)
+        heap.extend(handles)
+        heapq.heapify(heap)         # Keys are unique, so the entries never compare their items
+        for pos, entry in enumerate(heap):
+            entry[2] = pos
+        return handles
+
+    def peek(self):
+        return self._heap[0][1]
+
+    def pop(self):
+        heap = self._heap
+        last = heap.pop()
+        if heap:
+            top = heap[0]
+            heap[0] = last
+            last[2] = 0
+            self._siftdown(0)
+        else:
+            top = last
+        top[2] = -1
+        return top[1]
+
+    def update_priority(self, handle, priority):
+        self._check(handle)
+        handle[0] = (-priority, handle[0][1])     # Keep the original insertion order
+        self._fix(handle[2])
+
+    def remove(self, handle):
+        self._check(handle)
+        heap = self._heap
+        last = heap.pop()
+        if last is not handle:
+            pos = handle[2]
+            heap[pos] = last
+            last[2] = pos
+            self._fix(pos)
+        handle[2] = -1
+        return handle[1]
+
+    def _check(self, handle):
+        pos = handle[2]
+        if pos < 0 or pos >= len(self._heap) or self._heap[pos] is not handle:
+            raise KeyError('{!r} is not in the queue'.format(handle[1]))
+
+    def _fix(self, pos):
+        heap = self._heap
+        if pos > 0 and heap[pos][0] < heap[(pos - 1) >> 1][0]:
+            self._siftup(pos)
+        else:
+            self._siftdown(pos)
+
+    def _siftup(self, pos):
+        heap = self._heap
+        entry = heap[pos]
+        key = entry[0]
+        while pos > 0:
+            parentpos = (pos - 1) >> 1
+            parent = heap[parentpos]
+            if not key < parent[0]:
+                break
+            heap[pos] = parent
+            parent[2] = pos
+            pos = parentpos
+        heap[pos] = entry
+        entry[2] = pos
+
+    def _siftdown(self, pos):
+        heap = self._heap
+        size = len(heap)
+        entry = heap[pos]
+        key = entry[0]
+        child = 2 * pos + 1
+        while child < size:
+            right = child + 1
+            if right < size and heap[right][0] < heap[child][0]:
+                child = right
+            smaller = heap[child]
+            if not smaller[0] < key:
+                break
+            heap[pos] = smaller
+            smaller[2] = pos
+            pos = child
+            child = 2 * pos + 1
+        heap[pos] = entry
+        entry[2] = pos
+
+q = IndexedPriorityQueue()
+foo = q.push(Item('foo'), 1)
+q.push(Item('bar'), 5)
+spam = q.push(Item('spam'), 4)
+q.push_many([(Item('grok'), 1), (Item('lee'), 6)])
+q.update_priority(foo, 10)     # foo jumps to the front
+q.remove(spam)                 # spam is cancelled
+print(len(q), q.peek())
+while q:
+    print(q.pop())
+
+@benchmark(n=100000, changes=20000)
+def bench_priority_queue(n=1000000, changes=200000):
+    import random
+    import time
+
+    class TombstonePriorityQueue:
+        '''heapq with lazy deletion: dead entries are skipped on pop()'''
+        def __init__(self):
+            self._queue = []
+            self._index = 0
+            self._size = 0
+        def push(self, item, priority):
+            entry = [-priority, self._index, item, True]
+            self._index += 1
+            self._size += 1
+            heapq.heappush(self._queue, entry)
+            return entry
+        def remove(self, entry):
+            entry[3] = False
+            self._size -= 1
+        def update_priority(self, entry, priority):
+            self.remove(entry)
+            return self.push(entry[2], priority)
+        def pop(self):
+            while True:
+                entry = heapq.heappop(self._queue)
+                if entry[3]:
+                    self._size -= 1
+                    return entry[2]
+        def __len__(self):
+            return self._size
+
+    random.seed(0)
+    priorities = [random.randrange(1000) for _ in range(n)]
+    picks = random.sample(range(n), 2 * changes)
+    for queue in (IndexedPriorityQueue(), TombstonePriorityQueue()):
+        start = time.perf_counter()
+        handles = [queue.push(i, p) for i, p in enumerate(priorities)]
+        t_push = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in picks[:changes]:
+            handles[i] = queue.update_priority(handles[i], random.randrange(1000)) or handles[i]
+        for i in picks[changes:]:
+            queue.remove(handles[i])
+        t_change = time.perf_counter() - start
+        held = len(queue._heap if hasattr(queue, '_heap') else queue._queue)
+        start = time.perf_counter()
+        while queue:
+            queue.pop()
+        t_pop = time.perf_counter() - start
+        print('{:24} push {:.3f}s  update+remove {:.3f}s  pop all {:.3f}s  {} entries held'.format(
+            type(queue).__name__, t_push, t_change, t_pop, held))
+    start = time.perf_counter()
+    IndexedPriorityQueue().push_many(zip(range(n), priorities))
+    print('{:24} push_many {:.3f}s'.format('IndexedPriorityQueue', time.perf_counter() - start))
+
+# Sharing a priority queue between threads or coroutines
+# PriorityQueue above is a bare list, so two threads pushing at once can corrupt it. The
+# standard library already has the locking (queue.PriorityQueue for threads and
+# asyncio.PriorityQueue for coroutines, both with maxsize for backpressure); wrap them
+# so they take push(item, priority) and keep the (-priority, index, item) tiebreaker.
+# next() on itertools.count() is atomic, so the index needs no lock of its own.
+import queue
+import asyncio
+from itertools import count
+
+class ThreadSafePriorityQueue:
+    def __init__(self, maxsize=0):
+        self._queue = queue.PriorityQueue(maxsize)
+        self._index = count()
+
+    def put(self, item, priority, block=True, timeout=None):
+        # Blocks while the queue is full; raises queue.Full after timeout
+        self._queue.put((-priority, next(self._index), item), block, timeout)
+
+    def get(self, block=True, timeout=None):
+        # Blocks while the queue is empty; raises queue.Empty after timeout
+        return self._queue.get(block, timeout)[-1]
+
+    push = put
+    pop = get
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def full(self):
+        return self._queue.full()
+
+class AsyncPriorityQueue:
+    def __init__(self, maxsize=0):
+        self._queue = asyncio.PriorityQueue(maxsize)
+        self._index = count()
+
+    async def put(self, item, priority):
+        await self._queue.put((-priority, next(self._index), item))
+
+    def put_nowait(self, item, priority):
+        self._queue.put_nowait((-priority, next(self._index), item))
+
+    async def get(self):
+        return (await self._queue.get())[-1]
+
+    def get_nowait(self):
+        return self._queue.get_nowait()[-1]
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def full(self):
+        return self._queue.full()
+
+q = ThreadSafePriorityQueue(maxsize=2)
+q.put(Item('foo'), 1)
+q.put(Item('bar'), 5)
+try:
+    q.put(Item('spam'), 4, timeout=0.01)
+except queue.Full:
+    print('queue.Full')
+print(q.get(), q.get())
+try:
+    q.get(timeout=0.01)
+except queue.Empty:
+    print('queue.Empty')
+
+async def async_demo():
+    q = AsyncPriorityQueue()
+    for name, priority in [('foo', 1), ('bar', 5), ('spam', 4), ('grok', 1)]:
+        await q.put(Item(name), priority)
+    return [await q.get() for _ in range(len(q))]
+print(asyncio.run(async_demo()))
+
+@benchmark(producers=4, consumers=4, n=40000)
+def bench_contention(producers=4, consumers=4, n=100000, maxsize=1000):
+    import random
+    import threading
+    import time
+
+    def report(name, elapsed, latencies):
+        latencies.sort()
+        print('{:28} {:>10,.0f} ops/s  p99 latency {:8.3f} ms'.format(
+            name, n / elapsed, latencies[int(len(latencies) * 0.99)] * 1000))
+
+    # Threads: every producer puts n // producers items, then one sentinel per
+    # consumer is queued below every real priority.
+    q = ThreadSafePriorityQueue(maxsize)
+    latencies = []
+    def produce(k):
+        for _ in range(k):
+            q.put(time.perf_counter(), random.randrange(10))
+    def consume():
+        local = []
+        while True:
+            stamp = q.get()
+            if stamp is None:
+                break
+            local.append(time.perf_counter() - stamp)
+        latencies.extend(local)
+    start = time.perf_counter()
+    workers = [threading.Thread(target=consume) for _ in range(consumers)]
+    feeders = [threading.Thread(target=produce, args=(n // producers,)) for _ in range(producers)]
+    for t in workers + feeders:
+        t.start()
+    for t in feeders:
+        t.join()
+    for _ in workers:
+        q.put(None, -1)
+    for t in workers:
+        t.join()
+    report('threads {}P/{}C'.format(producers, consumers), time.perf_counter() - start, latencies)
+
+    async def run_async():
+        q = AsyncPriorityQueue(maxsize)
+        latencies = []
+        async def produce(k):
+            for _ in range(k):
+                await q.put(time.perf_counter(), random.randrange(10))
+        async def consume():
+            while True:
+                stamp = await q.get()
+                if stamp is None:
+                    break
+                latencies.append(time.perf_counter() - stamp)
+        start = time.perf_counter()
+        workers = [asyncio.create_task(consume()) for _ in range(consumers)]
+        await asyncio.gather(*(produce(n // producers) for _ in range(producers)))
+        for _ in workers:
+            await q.put(None, -1)
+        await asyncio.gather(*workers)
+        report('asyncio {}P/{}C'.format(producers, consumers), time.perf_counter() - start, latencies)
+    asyncio.run(run_async())
+
+# A priority queue larger than memory
+# Only the hot part of the queue is kept as an in-memory heap. When it grows past
+# hot_size, the coldest half is written out as a sorted run file. pop() compares the heap
+# top with the head of every run (a second, tiny heap), so runs are merged back lazily one
+# record at a time. Runs are compacted by size tier: a run of up to one spill is tier 0,
+# up to fanin spills tier 1, and so on. When fanin runs share a tier they are k-way merged
+# with heapq.merge() into one run of the next tier. Each record is rewritten once per
+# tier, O(log n) times in all, and at most (fanin - 1) runs stay open per tier.
+#
+# Every push and pop is appended to a log. A checkpoint writes a MANIFEST (runs plus
+# the read offset of each) and starts a new log holding just the hot heap. On restart the
+# runs are reopened at their offsets and the log is replayed; pops are deterministic, so
+# the log only needs to say that a pop happened. Keys are (-priority, index) as in 1.5.
+# Run files, the new log and the directory itself are fsynced before the manifest that
+# names them replaces the old one, and only then is the old log deleted.
+import json
+import pickle
+import tempfile
+
+class DiskPriorityQueue:
+    def __init__(self, dirname, hot_size=100000, fanin=4, sync=False):
+        self.dirname = dirname
+        self.hot_size = hot_size
+        self.fanin = max(fanin, 2)
+        self.sync = sync            # flush and fsync the log on every operation
+        os.makedirs(dirname, exist_ok=True)
+        self._hot = []              # heap of (key, item)
+        self._runs = {}             # name -> [file, offset of the head record, records left]
+        self._heads = []            # heap of (key, run name, item), one per run
+        self._size = 0
+        self._index = 0
+        self._seq = 0
+        self._log = None
+        self._log_records = 0
+        self._written = 0           # records written to runs, spills and merges alike
+        self._recover()
+
+    def __len__(self):
+        return self._size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def push(self, item, priority):
+        key = (-priority, self._index)
+        self._index += 1
+        self._append(('+', key, item))
+        heapq.heappush(self._hot, (key, item))
+        self._size += 1
+        if len(self._hot) > self.hot_size:
+            self._spill()
+        elif self._log_records > 4 * self.hot_size:
+            self._checkpoint()
+
+    def pop(self):
+        key, item = self._pop_entry()
+        self._append(('-', key))
+        if self._log_records > 4 * self.hot_size:
+            self._checkpoint()
+        return item
+
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
+        for run in self._runs.values():
+            run[0].close()
+
+    def _path(self, name):
+        return os.path.join(self.dirname, name)
+
+    def _new_name(self, prefix):
+        self._seq += 1
+        return '{}-{:06d}'.format(prefix, self._seq)
+
+    def _append(self, record):
+        pickle.dump(record, self._log, pickle.HIGHEST_PROTOCOL)
+        self._log_records += 1
+        if self.sync:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+    def _pop_entry(self):
+        hot, heads = self._hot, self._heads
+        if heads and (not hot or heads[0][0] < hot[0][0]):
+            key, name, item = heapq.heappop(heads)
+            run = self._runs[name]
+            run[1] = run[0].tell()
+            run[2] -= 1
+            self._advance(name)
+        elif hot:
+            key, item = heapq.heappop(hot)
+        else:
+            raise IndexError('pop from an empty priority queue')
+        self._size -= 1
+        return key, item
+
+    def _open_run(self, name, offset, left):
+        f = open(self._path(name), 'rb', buffering=1 << 20)   # Large read-ahead buffer
+        f.seek(offset)
+        self._runs[name] = [f, offset, left]
+        self._size += left
+        self._advance(name)
+
+    def _advance(self, name):
+        run = self._runs[name]
+        if run[2] == 0:
+            run[0].close()
+            del self._runs[name]
+        else:
+            key, item = pickle.load(run[0])
+            heapq.heappush(self._heads, (key, name, item))
+
+    def _write_run(self, entries):
+        name = self._new_name('run')
+        count = 0
+        with open(self._path(name), 'wb', buffering=1 << 20) as f:
+            for entry in entries:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())        # On disk before a manifest can point at it
+        self._written += count
+        return name, count
+
+    def _spill(self):
+        entries = sorted(self._hot)
+        keep = self.hot_size // 2
+        self._hot = entries[:keep]          # A sorted list is already a heap
+        self._size -= len(entries) - keep
+        name, count = self._write_run(entries[keep:])
+        self._open_run(name, 0, count)
+        self._compact()
+        self._checkpoint()
+
+    def _tier(self, left):
+        tier = 0
+        limit = self.hot_size - self.hot_size // 2      # The size of one spill
+        while left > limit:
+            tier += 1
+            limit *= self.fanin
+        return tier
+
+    def _compact(self):
+        # A merge can fill the next tier up, so keep going until no tier is full
+        while True:
+            tiers = {}
+            for name, run in self._runs.items():
+                tiers.setdefault(self._tier(run[2]), []).append(name)
+            full = [names for tier, names in sorted(tiers.items()) if len(names) >= self.fanin]
+            if not full:
+                return
+            self._merge_runs(full[0])
+
+    def _merge_runs(self, names):
+        def read(name, offset, left):
+            with open(self._path(name), 'rb', buffering=1 << 20) as f:
+                f.seek(offset)
+                for _ in range(left):
+                    yield pickle.load(f)
+        runs = []
+        for name in names:
+            f, offset, left = self._runs.pop(name)
+            f.close()
+            self._size -= left
+            runs.append((name, offset, left))
+        names = set(names)
+        self._heads = [head for head in self._heads if head[1] not in names]
+        heapq.heapify(self._heads)
+        name, count = self._write_run(heapq.merge(*(read(*run) for run in runs)))
+        self._open_run(name, 0, count)
+
+    def _checkpoint(self):
+        name = self._new_name('log')
+        log = open(self._path(name), 'wb')
+        for key, item in self._hot:
+            pickle.dump(('+', key, item), log, pickle.HIGHEST_PROTOCOL)
+        log.flush()
+        os.fsync(log.fileno())
+        manifest = {'seq': self._seq, 'index': self._index, 'log': name,
+                    'runs': [[n, run[1], run[2]] for n, run in self._runs.items()]}
+        tmp = self._path('MANIFEST.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        self._sync_dir()                # The new runs and log are in the directory
+        os.replace(tmp, self._path('MANIFEST'))
+        self._sync_dir()                # ...and so is the new manifest, before the old log goes
+        if self._log:
+            self._log.close()
+        self._log = log
+        self._log_records = len(self._hot)
+        # Drop the logs and runs the new manifest no longer refers to
+        live = {name} | set(self._runs)
+        for fname in os.listdir(self.dirname):
+            if fname.startswith(('log-', 'run-')) and fname not in live:
+                os.remove(self._path(fname))
+
+    def _sync_dir(self):
+        if hasattr(os, 'O_DIRECTORY'):  # Windows can't open, or fsync, a directory
+            fd = os.open(self.dirname, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _recover(self):
+        try:
+            with open(self._path('MANIFEST')) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {'seq': 0, 'index': 0, 'log': None, 'runs': []}
+        self._seq = manifest['seq']
+        self._index = manifest['index']
+        for name, offset, left in manifest['runs']:
+            self._open_run(name, offset, left)
+        if manifest['log']:
+            with open(self._path(manifest['log']), 'rb') as f:
+                while True:
+                    try:
+                        record = pickle.load(f)
+                    except (EOFError, pickle.UnpicklingError):
+                        break               # End of log, or a record torn by a crash
+                    if record[0] == '+':
+                        heapq.heappush(self._hot, (record[1], record[2]))
+                        self._index = max(self._index, record[1][1] + 1)
+                        self._size += 1
+                    else:
+                        self._pop_entry()
+        self._checkpoint()
+
+with tempfile.TemporaryDirectory() as dirname:
+    with DiskPriorityQueue(dirname, hot_size=4) as q:
+        for name, priority in [('foo', 1), ('bar', 5), ('spam', 4), ('grok', 1), ('lee', 6)]:
+            q.push(name, priority)
+        print(q.pop(), len(q), sorted(os.listdir(dirname)))
+    with DiskPriorityQueue(dirname, hot_size=4) as q:      # Reopen: state comes back from disk
+        print([q.pop() for _ in range(len(q))])
+
+@benchmark(n=200000, hot_size=10000)
+def bench_disk_priority_queue(n=1000000, hot_size=50000):
+    import random
+    import time
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as dirname:
+        with DiskPriorityQueue(dirname, hot_size=hot_size) as q:
+            push_latencies = []
+            for i in range(n):
+                start = time.perf_counter()
+                q.push(i, random.randrange(1000))
+                push_latencies.append(time.perf_counter() - start)
+            t_push = math.fsum(push_latencies)
+            runs = len(q._runs)
+            written = q._written
+            latencies = []
+            for _ in range(n // 2):
+                start = time.perf_counter()
+                q.pop()
+                latencies.append(time.perf_counter() - start)
+                if random.random() < 0.5:      # Keep pushing while draining
+                    q.push(-1, random.randrange(1000))
+            latencies.sort()
+            print('{:,} items, hot_size {:,}: {:,.0f} pushes/s, {} runs on disk, '
+                  'each item written to a run {:.1f} times'.format(
+                      n, hot_size, n / t_push, runs, written / n))
+            print('push latency max {:.1f} ms'.format(max(push_latencies) * 1e3))
+            print('pop latency p50 {:.1f} us  p99 {:.1f} us  max {:.1f} ms'.format(
+                latencies[len(latencies) // 2] * 1e6, latencies[int(len(latencies) * 0.99)] * 1e6,
+                latencies[-1] * 1e3))
+
+# Hierarchical timer wheel for delayed jobs
+# When the priority is a due time, most timers are cancelled or expire in bulk, and the
+# heap pays O(log n) for every one of them. A timer wheel hashes each timer into a slot by
+# its due tick: level 0 has one slot per tick, and each level above has slots 256 times
+# as wide. schedule() and cancel() are a dict insert/delete. pop_due() expires whole
+# slots and, each time a level wraps around, cascades the next level's slot down.
+# Timers beyond the top level wait in one overflow slot, which is cascaded each time the
+# whole wheel wraps around. Each batch of expired timers comes out in (at, insertion order).
+import math
+
+class Timer:
+    __slots__ = ('at', 'tick', 'seq', 'item', 'level', 'slot')
+
+    def __repr__(self):
+        return 'Timer({!r}, {!r})'.format(self.at, self.item)
+
+class TimerWheel:
+    def __init__(self, resolution=0.001, start=0.0, bits=8, levels=4):
+        self.resolution = resolution
+        self.start = start
+        self._bits = bits
+        self._mask = (1 << bits) - 1
+        self._levels = levels
+        self._wheels = [[{} for _ in range(1 << bits)] for _ in range(levels)]
+        self._wheels.append([{}])   # Overflow: one slot above the top level
+        self._level_counts = [0] * (levels + 1)
+        self._horizon = 1 << (bits * levels)
+        self._now = 0               # Next tick to expire
+        self._seq = 0
+        self._count = 0
+        self._ready = deque()       # Expired by pop() but not handed out yet
+        self._ready_cancelled = 0   # Cancelled while in _ready, skipped by pop()
+
+    def __len__(self):
+        return self._count + len(self._ready) - self._ready_cancelled
+
+    def schedule(self, at, item):
+        timer = Timer()
+        timer.at = at
+        timer.tick = math.floor((at - self.start) / self.resolution)
+        timer.seq = self._seq
+        timer.item = item
+        self._seq += 1
+        self._place(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer.slot is None:
+            raise KeyError('{!r} has already expired or been cancelled'.format(timer))
+        if timer.slot is self._ready:
+            self._ready_cancelled += 1
+        else:
+            del timer.slot[timer]
+            self._level_counts[timer.level] -= 1
+            self._count -= 1
+        timer.slot = None
+
+    def pop_due(self, now):
+        '''Return the items of every timer due at or before the tick of now'''
+        target = math.floor((now - self.start) / self.resolution)
+        due = []
+        if self._ready and target >= self._now - 1:    # pop() expired the tick before _now
+            for timer in self._ready:
+                if timer.slot is not None:
+                    timer.slot = None
+                    due.append(timer)
+            self._ready.clear()
+            self._ready_cancelled = 0
+        due.extend(self._advance(target))
+        due.sort(key=lambda t: (t.at, t.seq))
+        return [timer.item for timer in due]
+
+    # Same interface as PriorityQueue, ordered by due time
+    def push(self, item, at):
+        return self.schedule(at, item)
+
+    def pop(self):
+        '''Return the item of the earliest timer, moving the wheel's clock up to it'''
+        ready = self._ready
+        while True:
+            while ready:
+                timer = ready.popleft()
+                if timer.slot is ready:
+                    timer.slot = None
+                    return timer.item
+                self._ready_cancelled -= 1
+            if not self._count:
+                raise IndexError('pop from an empty timer wheel')
+            batch = self._advance(math.inf, stop=True)
+            batch.sort(key=lambda t: (t.at, t.seq))
+            for timer in batch:
+                timer.slot = ready      # Still cancellable until it is handed out
+            ready.extend(batch)
+
+    def _place(self, timer):
+        tick = max(timer.tick, self._now)       # Overdue timers expire on the next tick
+        delta = tick - self._now
+        if delta >= self._horizon:
+            level, index = self._levels, 0      # Placed again when the wheel wraps
+        else:
+            level = 0
+            while level < self._levels - 1 and delta >= 1 << (self._bits * (level + 1)):
+                level += 1
+            index = (tick >> (self._bits * level)) & self._mask
+        timer.level = level
+        timer.slot = self._wheels[level][index]
+        timer.slot[timer] = None
+        self._level_counts[level] += 1
+
+    def _cascade(self, level, index):
+        slot = self._wheels[level][index]
+        if slot:
+            self._level_counts[level] -= len(slot)
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._place(timer)
+
+    def _next_cascade(self):
+        '''The first tick from _now on where a non-empty slot above level 0 cascades'''
+        now, bits, mask = self._now, self._bits, self._mask
+        best = math.inf
+        for level in range(1, self._levels):
+            if self._level_counts[level]:
+                shift = bits * level
+                start = -(-now >> shift)            # First slot boundary at or after now
+                slots = self._wheels[level]
+                for k in range(mask + 1):
+                    if slots[(start + k) & mask]:
+                        best = min(best, (start + k) << shift)
+                        break
+        overflow = self._wheels[self._levels][0]
+        if overflow:
+            # Skip the wraps at which every overflow timer would go straight back
+            first = max(now, min(timer.tick for timer in overflow) - self._horizon + 1)
+            best = min(best, -(-first // self._horizon) * self._horizon)
+        return best
+
+    def _advance(self, target, stop=False):
+        expired = []
+        bits, mask = self._bits, self._mask
+        while self._now <= target and self._count:
+            now = self._now
+            if not now & mask:
+                for level in range(1, self._levels):
+                    index = (now >> (bits * level)) & mask
+                    self._cascade(level, index)
+                    if index:
+                        break
+                if not now & (self._horizon - 1):
+                    self._cascade(self._levels, 0)
+            slot = self._wheels[0][now & mask]
+            if slot:
+                batch = list(slot)
+                slot.clear()
+                for timer in batch:
+                    timer.slot = None
+                self._level_counts[0] -= len(batch)
+                self._count -= len(batch)
+                expired.extend(batch)
+            self._now = now + 1
+            if stop and expired:
+                break
+            if not self._level_counts[0] and self._count:
+                # Nothing left on level 0: jump to the next cascade of an occupied slot
+                self._now = min(self._next_cascade(), target + 1)
+        if not self._count and not stop and self._now <= target:
+            self._now = target + 1
+        return expired
+
+w = TimerWheel(resolution=1)
+for name, at in [('foo', 5), ('bar', 300), ('spam', 70000), ('grok', 5)]:
+    w.schedule(at, Item(name))
+h = w.schedule(10, Item('lee'))
+w.cancel(h)
+print(len(w), w.pop_due(10), w.pop_due(299), w.pop_due(1000), len(w))
+print(w.pop(), len(w))
+
+@benchmark(n=200000)
+def bench_timer_wheel(n=1000000, horizon=60.0, step=0.01, cancel=0.1):
+    import random
+    import time
+    random.seed(0)
+    times = [random.uniform(0, horizon) for _ in range(n)]
+    victims = random.sample(range(n), int(n * cancel))
+
+    start = time.perf_counter()
+    heap = []
+    entries = []
+    for seq, at in enumerate(times):
+        entry = [at, seq, seq, True]        # Lazy deletion: clear the flag to cancel
+        heapq.heappush(heap, entry)
+        entries.append(entry)
+    for i in victims:
+        entries[i][3] = False
+    fired = 0
+    now = 0.0
+    while heap:
+        now += step
+        while heap and heap[0][0] <= now:
+            if heapq.heappop(heap)[3]:
+                fired += 1
+    t_heap = time.perf_counter() - start
+
+    start = time.perf_counter()
+    wheel = TimerWheel(resolution=step / 10)
+    handles = [wheel.schedule(at, seq) for seq, at in enumerate(times)]
+    for i in victims:
+        wheel.cancel(handles[i])
+    fired_wheel = 0
+    now = 0.0
+    while len(wheel):
+        now += step
+        fired_wheel += len(wheel.pop_due(now))
+    t_wheel = time.perf_counter() - start
+
+    print('{:,} timers, {:.0%} cancelled, {} fired'.format(n, cancel, fired))
+    print('heapq       : {:.3f}s'.format(t_heap))
+    print('TimerWheel  : {:.3f}s ({} fired)'.format(t_wheel, fired_wheel))
+
 
 # 1.6 Mapping Keys to Multiple Values in a Dictionary
 d = {'a':[1, 2, 3],
@@ -251,6 +1320,134 @@ d = defaultdict(list)
 for key, value in pairs:
     d[key].append(value)
 
+# Packed multivalued dictionary (CSR layout)
+# defaultdict(list) costs a whole list object per key. Once the data stops changing, all
+# of the values can live in one packed array, grouped by key, next to an offsets array:
+# the values of key number i are values[offsets[i]:offsets[i+1]]. MultiDictBuilder
+# collects (key, value) pairs, and freeze() groups them with a counting sort.
+# Numeric values go into a typed array ('q', 'd', ...) and d[key] is a memoryview slice
+# of it, so nothing is copied on lookup.
+from array import array
+from collections.abc import Mapping
+
+class MultiDict(Mapping):
+    def __init__(self, index, offsets, values):
+        self._index = index             # key -> key number
+        self._offsets = offsets
+        self._values = values
+        self._view = memoryview(values) if isinstance(values, array) else values
+
+    @classmethod
+    def from_pairs(cls, pairs, typecode=None):
+        builder = MultiDictBuilder(typecode)
+        builder.update(pairs)
+        return builder.freeze()
+
+    def __getitem__(self, key):
+        i = self._index[key]
+        return self._view[self._offsets[i]:self._offsets[i + 1]]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __repr__(self):
+        return 'MultiDict({!r})'.format({key: list(self[key]) for key in self})
+
+class MultiDictBuilder:
+    def __init__(self, typecode=None):
+        self.typecode = typecode
+        self._index = {}
+        self._keys = array('q')         # key number of every pair
+        self._values = array(typecode) if typecode else []
+
+    def add(self, key, value):
+        i = self._index.get(key)
+        if i is None:
+            i = self._index[key] = len(self._index)
+        self._keys.append(i)
+        self._values.append(value)
+
+    def update(self, pairs):
+        index, keys, values = self._index, self._keys, self._values
+        for key, value in pairs:
+            i = index.get(key)
+            if i is None:
+                i = index[key] = len(index)
+            keys.append(i)
+            values.append(value)
+
+    def freeze(self):
+        nkeys = len(self._index)
+        if np is not None and self.typecode:
+            ids = np.frombuffer(self._keys, dtype=np.int64)
+            order = np.argsort(ids, kind='stable')
+            offsets = array('q', np.concatenate(([0], np.cumsum(np.bincount(ids, minlength=nkeys)))).tolist())
+            values = array(self.typecode)
+            values.frombytes(np.asarray(self._values)[order].tobytes())
+        else:
+            offsets = array('q', bytes(8 * (nkeys + 1)))
+            for i in self._keys:
+                offsets[i + 1] += 1
+            for i in range(nkeys):
+                offsets[i + 1] += offsets[i]
+            cursor = offsets[:-1]
+            if self.typecode:
+                values = array(self.typecode, bytes(self._values.itemsize * len(self._values)))
+            else:
+                values = [None] * len(self._values)
+            for i, value in zip(self._keys, self._values):
+                pos = cursor[i]
+                values[pos] = value
+                cursor[i] = pos + 1
+        return MultiDict(dict(self._index), offsets, values)
+
+d = MultiDict.from_pairs([('a', 1), ('b', 4), ('a', 2), ('c', 5)], typecode='q')
+print(d, d['a'].tolist(), len(d), 'b' in d)
+print(MultiDict.from_pairs([('a', 'x'), ('b', 'y'), ('a', 'z')]))
+
+@benchmark(npairs=500000, nkeys=50000, lookups=200000)
+def bench_multidict(npairs=5000000, nkeys=500000, lookups=1000000):
+    import random
+    import time
+    import tracemalloc
+    random.seed(0)
+    keys = ['key{}'.format(n) for n in range(nkeys)]
+    key_numbers = array('q', (random.randrange(nkeys) for _ in range(npairs)))
+    values = array('q', (random.randrange(1 << 40) for _ in range(npairs)))
+    probes = [keys[random.choice(key_numbers)] for _ in range(lookups)]
+
+    def pairs():        # Fresh int objects for every value, as when reading them from a file
+        return ((keys[k], v) for k, v in zip(key_numbers, values))
+    def build_list():
+        d = defaultdict(list)
+        for key, value in pairs():
+            d[key].append(value)
+        return d
+    def build_set():
+        d = defaultdict(set)
+        for key, value in pairs():
+            d[key].add(value)
+        return d
+    def build_packed():
+        return MultiDict.from_pairs(pairs(), typecode='q')
+
+    print('{:,} pairs, {:,} keys'.format(npairs, nkeys))
+    for name, build in [('defaultdict(list)', build_list), ('defaultdict(set)', build_set),
+                        ("MultiDict('q')", build_packed)]:
+        tracemalloc.start()
+        d = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        start = time.perf_counter()
+        for key in probes:
+            d[key]
+        per_lookup = (time.perf_counter() - start) / lookups
+        print('{:18} {:8.1f} MB  {:6.0f} ns/lookup'.format(name, size / 1e6, per_lookup * 1e9))
+        del d
+
 
 # OrderedDict from the collections module
 # To control the order of items in a dictionary.
@@ -267,6 +1464,290 @@ for key, value in d.items():
 import json
 print(json.dumps(d))
 
+# A bounded LRU/LFU cache built on OrderedDict
+# An OrderedDict is an LRU list already: move_to_end() on every hit, popitem(last=False)
+# evicts the least recently used entry. For LFU, keep one OrderedDict of keys per use
+# count and remember the smallest count, so eviction is O(1) as well. Entries carry a
+# size (sys.getsizeof() by default) for the byte bound, and an optional expiry time.
+#
+# Keys are spread over independent segments, each with its own lock, so threads only
+# contend when they hit the same segment; there is no global lock. The bounds hold for the
+# whole cache: put() makes room in the key's own segment, so LRU/LFU order is kept per
+# segment, and only evicts from another segment when its own has nothing left to give.
+# A value bigger than maxbytes on its own is not cached. stats() adds up the counters.
+import sys
+import time
+import threading
+from functools import wraps
+
+class _LRUSegment:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = OrderedDict()       # key -> [value, nbytes, expires]
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def touch(self, key, entry):
+        self.data.move_to_end(key)
+
+    def insert(self, key, entry):
+        self.data[key] = entry
+
+    def remove(self, key):
+        entry = self.data.pop(key)
+        self.nbytes -= entry[1]
+        return entry
+
+    def victim(self):
+        return next(iter(self.data))
+
+    def items(self):
+        return list(self.data.items())  # Least recently used first
+
+class _LFUSegment(_LRUSegment):
+    def __init__(self):
+        super().__init__()
+        self.data = {}                  # key -> [value, nbytes, expires, uses]
+        self.buckets = defaultdict(OrderedDict)
+        self.min_uses = 0
+
+    def touch(self, key, entry):
+        uses = entry[3]
+        bucket = self.buckets[uses]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[uses]
+            if self.min_uses == uses:
+                self.min_uses = uses + 1
+        entry[3] = uses + 1
+        self.buckets[uses + 1][key] = None
+
+    def insert(self, key, entry):
+        entry.append(1)
+        self.data[key] = entry
+        self.buckets[1][key] = None
+        self.min_uses = 1
+
+    def remove(self, key):
+        entry = super().remove(key)
+        bucket = self.buckets[entry[3]]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[entry[3]]
+            if self.buckets and self.min_uses == entry[3]:
+                self.min_uses = min(self.buckets)
+        return entry
+
+    def victim(self):
+        return next(iter(self.buckets[self.min_uses]))
+
+    def items(self):
+        return sorted(self.data.items(), key=lambda item: item[1][3])
+
+class Cache:
+    _missing = object()
+    _kwd_mark = object()        # Separates positional from keyword arguments in memoize() keys
+
+    def __init__(self, maxsize=1024, maxbytes=None, ttl=None, policy='lru', segments=8,
+                 sizeof=sys.getsizeof):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("policy must be 'lru' or 'lfu'")
+        self.policy = policy
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        segment = _LRUSegment if policy == 'lru' else _LFUSegment
+        self._segments = [segment() for _ in range(max(1, min(segments, maxsize)))]
+
+    def _segment(self, key):
+        return self._segments[hash(key) % len(self._segments)]
+
+    def _full(self, size=0, nbytes=0):
+        # Totals are read without the other segments' locks, so they can be slightly stale
+        for seg in self._segments:
+            size += len(seg.data)
+            nbytes += seg.nbytes
+        return size > self.maxsize or bool(self.maxbytes and nbytes > self.maxbytes)
+
+    def get(self, key, default=None):
+        seg = self._segment(key)
+        with seg.lock:
+            entry = seg.data.get(key)
+            if entry is None:
+                seg.misses += 1
+                return default
+            if entry[2] is not None and entry[2] <= time.monotonic():
+                seg.remove(key)
+                seg.expirations += 1
+                seg.misses += 1
+                return default
+            seg.touch(key, entry)
+            seg.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        nbytes = self.sizeof(value) if self.sizeof else 0
+        entry = [value, nbytes, None if ttl is None else time.monotonic() + ttl]
+        seg = self._segment(key)
+        with seg.lock:
+            if key in seg.data:
+                seg.remove(key)
+            if self.maxbytes and nbytes > self.maxbytes:
+                return              # It would push out everything else and still not fit
+            # Make room first, so that LFU never picks the new entry as its victim
+            while seg.data and self._full(1, nbytes):
+                seg.remove(seg.victim())
+                seg.evictions += 1
+            seg.insert(key, entry)
+            seg.nbytes += nbytes
+        # Its own segment ran dry: take the rest from the fullest of the others
+        while self._full():
+            other = max((s for s in self._segments if s is not seg), key=lambda s: len(s.data),
+                        default=seg)
+            with other.lock:
+                if not other.data:
+                    break
+                other.remove(other.victim())
+                other.evictions += 1
+
+    def __getitem__(self, key):
+        value = self.get(key, self._missing)
+        if value is self._missing:
+            raise KeyError(key)
+        return value
+
+    __setitem__ = put
+
+    def __delitem__(self, key):
+        seg = self._segment(key)
+        with seg.lock:
+            seg.remove(key)
+
+    def __contains__(self, key):
+        return key in self._segment(key).data
+
+    def __len__(self):
+        size = 0
+        for seg in self._segments:
+            size += len(seg.data)
+        return size
+
+    def clear(self):
+        for seg in self._segments:
+            with seg.lock:
+                for key in list(seg.data):
+                    seg.remove(key)
+
+    def stats(self):
+        totals = dict.fromkeys(['hits', 'misses', 'evictions', 'expirations', 'size', 'bytes'], 0)
+        for seg in self._segments:
+            totals['hits'] += seg.hits
+            totals['misses'] += seg.misses
+            totals['evictions'] += seg.evictions
+            totals['expirations'] += seg.expirations
+            totals['size'] += len(seg.data)
+            totals['bytes'] += seg.nbytes
+        return totals
+
+    # Warm starts. Keys and values must survive json; tuple keys (as made by memoize())
+    # come back as tuples. Entries are written coldest first so restore() replays them
+    # in the same order, and each keeps its remaining time to live.
+    def snapshot(self, filename):
+        now = time.monotonic()
+        entries = []
+        for seg in self._segments:
+            with seg.lock:
+                for key, entry in seg.items():
+                    if entry[2] is None or entry[2] > now:
+                        entries.append([key, entry[0], None if entry[2] is None else entry[2] - now])
+        def encode(obj):
+            if obj is Cache._kwd_mark:
+                return {'kwargs': True}     # Keys are hashable, so no other dict turns up
+            raise TypeError('{!r} is not JSON serializable'.format(obj))
+        with open(filename, 'w') as f:
+            json.dump({'policy': self.policy, 'entries': entries}, f, default=encode)
+
+    def restore(self, filename):
+        def totuple(key):
+            if isinstance(key, dict):
+                return Cache._kwd_mark
+            return tuple(totuple(k) for k in key) if isinstance(key, list) else key
+        with open(filename) as f:
+            snapshot = json.load(f)
+        for key, value, ttl in snapshot['entries']:
+            self.put(totuple(key), value, ttl)
+
+def memoize(maxsize=128, **kwargs):
+    def decorate(func):
+        cache = Cache(maxsize, **kwargs)
+        missing = Cache._missing
+        mark = (Cache._kwd_mark,)
+        @wraps(func)
+        def wrapper(*args, **kw):
+            key = args + mark + tuple(sorted(kw.items())) if kw else args
+            value = cache.get(key, missing)
+            if value is missing:
+                value = func(*args, **kw)
+                cache.put(key, value)
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorate
+
+c = Cache(maxsize=3, segments=1)
+for key in ['foo', 'bar', 'spam']:
+    c[key] = key.upper()
+c['foo']                        # 'bar' is now the least recently used
+c['grok'] = 'GROK'
+print(list(c._segments[0].data), c.stats())
+
+c = Cache(maxsize=3, policy='lfu', segments=1)
+for key in ['foo', 'bar', 'spam', 'foo', 'spam', 'foo']:
+    if c.get(key) is None:
+        c[key] = key.upper()
+c['grok'] = 'GROK'              # 'bar' has been used the least
+print(sorted(c._segments[0].data), c.stats())
+
+@memoize(maxsize=100, ttl=60)
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+print(fib(80), fib.cache.stats())
+with tempfile.TemporaryDirectory() as dirname:
+    fib.cache.snapshot(os.path.join(dirname, 'fib.json'))
+    warm = Cache(maxsize=100)
+    warm.restore(os.path.join(dirname, 'fib.json'))
+    print(len(warm), warm[(80,)])
+
+@benchmark(n=200000)
+def bench_cache(n=1000000, keys=1000):
+    import random
+    from functools import lru_cache
+    random.seed(0)
+    probes = [random.randrange(keys) for _ in range(n)]
+
+    @lru_cache(maxsize=keys)
+    def f_lru(x):
+        return x
+    @memoize(maxsize=keys)
+    def f_memo(x):
+        return x
+    @memoize(maxsize=keys, policy='lfu')
+    def f_lfu(x):
+        return x
+    cache = Cache(maxsize=keys)
+    for x in range(keys):
+        f_lru(x), f_memo(x), f_lfu(x)
+        cache[x] = x
+
+    for name, func in [('functools.lru_cache', f_lru), ('memoize() lru', f_memo),
+                       ('memoize() lfu', f_lfu), ('Cache.get()', cache.get)]:
+        start = time.perf_counter()
+        for x in probes:
+            func(x)
+        print('{:20} {:6.0f} ns/hit'.format(name, (time.perf_counter() - start) / n * 1e9))
+
 
 # 1.8 Calculating with Dictionaries
 prices = {
@@ -301,6 +1782,249 @@ prices = {'AAA':45.23, 'ZZZ': 45.23}
 print(min(zip(prices.values(), prices.keys())))
 print(max(zip(prices.values(), prices.keys())))
 
+# Keeping min/max/sorted up to date under price updates
+# min(zip(...)) and sorted(zip(...)) start from scratch every time. PriceBook keeps the
+# dict together with a sorted index of the same (price, name) tuples, so ties are broken
+# by name exactly as above. The index is a list of sorted sublists of at most 2 * load
+# items plus a list of their maxima: bisect finds the sublist, and insort()/del only
+# move one short sublist, so an update costs O(log n) comparisons plus O(load) moves.
+# Positions (rank(), by_rank(), book[i]) go through a Fenwick tree over the sublist
+# lengths, which maps a position to (sublist, offset) and back in O(log n). It is patched
+# on every add/remove and rebuilt, lazily, only when a sublist is split or dropped.
+from bisect import bisect_left, insort
+from itertools import islice, takewhile
+from collections.abc import MutableMapping
+
+class SortedList:
+    def __init__(self, iterable=(), load=1000):
+        self._load = load
+        self._lists = []
+        self._maxes = []
+        self._tree = None               # Fenwick tree of len(sublist), None when out of date
+        self._len = 0
+        values = sorted(iterable)
+        for i in range(0, len(values), load):
+            self._lists.append(values[i:i + load])
+            self._maxes.append(values[min(i + load, len(values)) - 1])
+        self._len = len(values)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._lists)
+
+    def __reversed__(self):
+        return chain.from_iterable(map(reversed, reversed(self._lists)))
+
+    def add(self, value):
+        lists, maxes = self._lists, self._maxes
+        if not maxes:
+            lists.append([value])
+            maxes.append(value)
+            self._tree = None
+        else:
+            pos = bisect_left(maxes, value)
+            if pos == len(maxes):
+                pos -= 1
+                lists[pos].append(value)
+                maxes[pos] = value
+            else:
+                insort(lists[pos], value)
+            if len(lists[pos]) > 2 * self._load:        # Split a sublist that got too long
+                half = lists[pos][self._load:]
+                del lists[pos][self._load:]
+                maxes[pos] = lists[pos][-1]
+                lists.insert(pos + 1, half)
+                maxes.insert(pos + 1, half[-1])
+                self._tree = None
+            else:
+                self._grow(pos, 1)
+        self._len += 1
+
+    def remove(self, value):
+        lists, maxes = self._lists, self._maxes
+        pos = bisect_left(maxes, value)
+        if pos < len(maxes):
+            sub = lists[pos]
+            i = bisect_left(sub, value)
+            if sub[i] == value:
+                del sub[i]
+                self._len -= 1
+                if sub:
+                    maxes[pos] = sub[-1]
+                    self._grow(pos, -1)
+                else:
+                    del lists[pos]
+                    del maxes[pos]
+                    self._tree = None
+                return
+        raise ValueError('{!r} not in list'.format(value))
+
+    def _build_tree(self):
+        tree = [0] + [len(sub) for sub in self._lists]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+        return tree
+
+    def _grow(self, pos, delta):
+        tree = self._tree
+        if tree is not None:
+            pos += 1
+            while pos < len(tree):
+                tree[pos] += delta
+                pos += pos & -pos
+
+    def _offset(self, pos):
+        '''Number of values in the sublists before lists[pos]'''
+        tree = self._build_tree() if self._tree is None else self._tree
+        total = 0
+        while pos:
+            total += tree[pos]
+            pos &= pos - 1
+        return total
+
+    def _locate(self, index):
+        '''(pos, i) such that lists[pos][i] is the value at 0 <= index < len'''
+        tree = self._build_tree() if self._tree is None else self._tree
+        pos = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            if pos + step < len(tree) and tree[pos + step] <= index:
+                pos += step
+                index -= tree[pos]
+            step >>= 1
+        return pos, index
+
+    def __getitem__(self, index):
+        if not -self._len <= index < self._len:
+            raise IndexError('list index out of range')
+        if index == 0 or index == -1:   # min() and max() need no tree
+            return self._lists[index][index]
+        pos, i = self._locate(index % self._len)
+        return self._lists[pos][i]
+
+    def index(self, value):
+        pos = bisect_left(self._maxes, value)
+        if pos < len(self._maxes):
+            sub = self._lists[pos]
+            i = bisect_left(sub, value)
+            if sub[i] == value:
+                return self._offset(pos) + i
+        raise ValueError('{!r} not in list'.format(value))
+
+    def islice(self, start=None, stop=None):
+        '''Yield the values at positions start <= i < stop in order'''
+        start, stop, _ = slice(start, stop).indices(self._len)
+        if start >= stop:
+            return
+        lists = self._lists
+        pos, i = self._locate(start)
+        left = stop - start
+        while left > 0:
+            chunk = lists[pos][i:i + left]
+            yield from chunk
+            left -= len(chunk)
+            pos += 1
+            i = 0
+
+    def irange(self, lo, hi=None):
+        '''Yield the values v with lo <= v (and v <= hi) in order'''
+        lists = self._lists
+        pos = bisect_left(self._maxes, lo)
+        if pos == len(lists):
+            return
+        i = bisect_left(lists[pos], lo)
+        for sub in lists[pos:]:
+            for j in range(i, len(sub)):
+                if hi is not None and sub[j] > hi:
+                    return
+                yield sub[j]
+            i = 0
+
+class PriceBook(MutableMapping):
+    def __init__(self, prices=(), load=1000):
+        self._prices = dict(prices)
+        self._index = SortedList(zip(self._prices.values(), self._prices.keys()), load)
+
+    def __getitem__(self, name):
+        return self._prices[name]
+
+    def __setitem__(self, name, price):
+        old = self._prices.get(name)
+        if old is not None:
+            self._index.remove((old, name))
+        self._prices[name] = price
+        self._index.add((price, name))
+
+    def __delitem__(self, name):
+        self._index.remove((self._prices.pop(name), name))
+
+    def __iter__(self):
+        return iter(self._prices)
+
+    def __len__(self):
+        return len(self._prices)
+
+    def min(self):
+        return self._index[0]
+
+    def max(self):
+        return self._index[-1]
+
+    def nsmallest(self, k):
+        return list(islice(self._index, k))
+
+    def nlargest(self, k):
+        return list(islice(reversed(self._index), k))
+
+    def range(self, lo, hi):
+        '''(price, name) pairs with lo <= price <= hi, cheapest first'''
+        return list(takewhile(lambda item: item[0] <= hi, self._index.irange((lo,))))
+
+    def rank(self, name):
+        return self._index.index((self._prices[name], name))
+
+    def by_rank(self, start, stop):
+        return list(self._index.islice(start, stop))
+
+book = PriceBook({'ACME': 45.23, 'AAPL': 612.78, 'IBM': 205.55, 'HPQ': 37.20, 'FB': 10.75})
+print(book.min(), book.max(), book.nsmallest(2))
+book['FB'] = 700.10
+book['AAA'] = 45.23
+book['ZZZ'] = 45.23
+del book['HPQ']
+print(book.min(), book.max(), book.rank('ZZZ'), book.range(40, 300), book.by_rank(1, 3))
+
+@benchmark(names=200000, updates=50000)
+def bench_price_book(names=1000000, updates=200000):
+    import random
+    random.seed(0)
+    prices = {'S{}'.format(n): round(random.uniform(1, 1000), 2) for n in range(names)}
+    book = PriceBook(prices)
+    changes = [('S{}'.format(random.randrange(names)), round(random.uniform(1, 1000), 2))
+               for _ in range(updates)]
+
+    start = time.perf_counter()
+    for name, price in changes:
+        book[name] = price
+        book.min()
+        book.max()
+    t_book = time.perf_counter() - start
+
+    queries = updates // 1000 or 1          # Recomputing from scratch is far too slow to
+    start = time.perf_counter()             # repeat for every update, so time a few
+    for name, price in changes[:queries]:
+        prices[name] = price
+        min(zip(prices.values(), prices.keys()))
+        max(zip(prices.values(), prices.keys()))
+    t_scan = (time.perf_counter() - start) / queries
+    print('{:,} names: PriceBook {:.1f} us/update+min+max, min(zip())/max(zip()) {:.1f} ms/query'.format(
+        names, t_book / updates * 1e6, t_scan * 1e3))
+
 
 # 1.9 Finding Commonalities in Two Dictionaries
 a = {
@@ -323,6 +2047,107 @@ print(a.items() & b.items())
 c = {key:a[key] for key in a.keys() - {'z', 'w'}}
 print(c)
 
+# Diffing big snapshots
+# a.keys() - b.keys() and a.items() & b.items() build whole new sets. A diff can be a
+# stream of ('added', key, new), ('removed', key, old) and ('changed', key, old, new)
+# tuples instead. In memory, the keys can be split into partitions by hash and each
+# partition diffed by its own process. For snapshots larger than memory, write both as
+# files sorted by key (one "key<TAB>value" line each) and merge-join them in one pass.
+def diff_dicts(a, b):
+    for key, old in a.items():
+        if key not in b:
+            yield ('removed', key, old)
+        elif b[key] != old:
+            yield ('changed', key, old, b[key])
+    for key, new in b.items():
+        if key not in a:
+            yield ('added', key, new)
+
+def diff_partition(a, b):
+    return list(diff_dicts(a, b))
+
+def parallel_diff(a, b, partitions=8, workers=None):
+    def split(d):
+        parts = [{} for _ in range(partitions)]
+        for key, value in d.items():
+            parts[hash(key) % partitions][key] = value
+        return parts
+    with ProcessPoolExecutor(workers) as pool:
+        for changes in pool.map(diff_partition, split(a), split(b)):
+            yield from changes
+
+def diff_sorted(a, b):
+    '''Merge-join two iterables of (key, value) pairs, both sorted by key'''
+    a, b = iter(a), iter(b)
+    missing = object()
+    ka, va = next(a, (missing, None))
+    kb, vb = next(b, (missing, None))
+    while ka is not missing and kb is not missing:
+        if ka < kb:
+            yield ('removed', ka, va)
+            ka, va = next(a, (missing, None))
+        elif kb < ka:
+            yield ('added', kb, vb)
+            kb, vb = next(b, (missing, None))
+        else:
+            if va != vb:
+                yield ('changed', ka, va, vb)
+            ka, va = next(a, (missing, None))
+            kb, vb = next(b, (missing, None))
+    while ka is not missing:
+        yield ('removed', ka, va)
+        ka, va = next(a, (missing, None))
+    while kb is not missing:
+        yield ('added', kb, vb)
+        kb, vb = next(b, (missing, None))
+
+def read_snapshot(filename):
+    with open(filename, buffering=1 << 20) as f:
+        for line in f:
+            key, _, value = line.rstrip('\n').partition('\t')
+            yield key, value
+
+def diff_sorted_files(filename_a, filename_b):
+    return diff_sorted(read_snapshot(filename_a), read_snapshot(filename_b))
+
+print(list(diff_dicts(a, b)))
+print(list(diff_sorted(sorted(a.items()), sorted(b.items()))))
+
+@benchmark(n=200000)
+def bench_diff(n=1000000, churn=0.05):
+    import random
+    random.seed(0)
+    a = {'k{:09d}'.format(i): i for i in range(n)}
+    b = dict(a)
+    for i in random.sample(range(n), int(n * churn)):
+        key = 'k{:09d}'.format(i)
+        if random.random() < 0.5:
+            del b[key]
+        else:
+            b[key] = -i
+    for i in range(n, n + int(n * churn / 2)):
+        b['k{:09d}'.format(i)] = i
+
+    def report(name, func):
+        start = time.perf_counter()
+        changes = 0
+        for _ in func():
+            changes += 1
+        print('{:28} {:.3f}s  {:,} changes'.format(name, time.perf_counter() - start, changes))
+
+    report('keys() set operations', lambda: chain(
+        a.keys() - b.keys(), b.keys() - a.keys(),
+        [key for key in a.keys() & b.keys() if a[key] != b[key]]))
+    report('diff_dicts()', lambda: diff_dicts(a, b))
+    report('parallel_diff()', lambda: parallel_diff(a, b))
+    with tempfile.TemporaryDirectory() as dirname:
+        filenames = []
+        for name, d in [('a.tsv', a), ('b.tsv', b)]:
+            filenames.append(os.path.join(dirname, name))
+            with open(filenames[-1], 'w') as f:
+                f.writelines('{}\t{}\n'.format(key, d[key]) for key in sorted(d))
+        report('diff_sorted_files()', lambda: diff_sorted_files(*filenames))
+
 
 # 1.10 Removing Duplicates from a Sequence while Maintaining Order
 def dedupe(items):
@@ -349,6 +2174,272 @@ print(list(dedupe(a, key=lambda d: (d['x'], d['y']))))
 a = [1, 5, 2, 1, 9, 1, 5, 10]
 print(set(a))
 
+# dedupe() on endless streams
+# The set of seen keys grows forever. Let the caller pass in what remembers the keys:
+# anything with `in` and add() will do. A Bloom filter answers `in` from a bit array
+# (about 1.8 bytes per key at a 0.1% false-positive rate); a false positive drops an item
+# that was not a duplicate. ScalableBloomFilter chains bigger and stricter filters as keys
+# arrive, so the total error rate stays under error_rate. WindowSet is exact but only
+# remembers the last maxlen distinct keys.
+def dedupe(items, key=None, seen=None):
+    seen = set() if seen is None else seen
+    for item in items:
+        val = item if key is None else key(item)
+        if val not in seen:
+            yield item
+            seen.add(val)
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._m = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._k = max(1, round(self._m / capacity * math.log(2)))
+        self._bits = bytearray((self._m + 7) // 8)
+        self._count = 0
+
+    def _positions(self, key):
+        # Double hashing from one hash(): h1 + i * h2 for i in range(k). hash() of an int
+        # is the int itself, so mix the bits first.
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1 = (h * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h2 = (((h ^ (h >> 31)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF) | 1
+        m = self._m
+        return [(h1 + i * h2) % m for i in range(self._k)]
+
+    def __contains__(self, key):
+        bits = self._bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        bits = self._bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def nbytes(self):
+        return len(self._bits)
+
+class ScalableBloomFilter:
+    def __init__(self, initial_capacity=100000, error_rate=0.001, growth=2, tightening=0.5):
+        self.growth = growth
+        self.tightening = tightening
+        # The error rates form a geometric series that adds up to error_rate
+        self._filters = [BloomFilter(initial_capacity, error_rate * (1 - tightening))]
+
+    def __contains__(self, key):
+        for f in reversed(self._filters):
+            if key in f:
+                return True
+        return False
+
+    def add(self, key):
+        last = self._filters[-1]
+        if len(last) >= last.capacity:
+            last = BloomFilter(last.capacity * self.growth, last.error_rate * self.tightening)
+            self._filters.append(last)
+        last.add(key)
+
+    def __len__(self):
+        size = 0
+        for f in self._filters:
+            size += len(f)
+        return size
+
+    def nbytes(self):
+        size = 0
+        for f in self._filters:
+            size += f.nbytes()
+        return size
+
+class WindowSet:
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self._keys = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def add(self, key):
+        if key not in self._keys:
+            self._keys[key] = None
+            if len(self._keys) > self.maxlen:
+                self._keys.popitem(last=False)
+
+    def __len__(self):
+        return len(self._keys)
+
+a = [1, 5, 2, 1, 9, 1, 5, 10]
+print(list(dedupe(a, seen=ScalableBloomFilter(4, error_rate=0.01))))
+print(list(dedupe(a, seen=WindowSet(2))))        # 1 and 5 come back once they leave the window
+
+@benchmark(n=200000)
+def bench_dedupe(n=1000000, distinct=0.5):
+    import random
+    import tracemalloc
+    random.seed(0)
+    keys = [random.randrange(int(n * distinct)) for _ in range(n)]
+    unique = len(set(keys))
+    for name, make in [('set()', set),
+                       ('BloomFilter(0.1%)', lambda: BloomFilter(unique)),
+                       ('ScalableBloomFilter', lambda: ScalableBloomFilter(unique // 16)),
+                       ('WindowSet(100000)', lambda: WindowSet(100000))]:
+        start = time.perf_counter()
+        kept = 0
+        for _ in dedupe(keys, seen=make()):
+            kept += 1
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()                 # Second pass, tracemalloc slows everything down
+        seen = make()
+        for _ in dedupe(keys, seen=seen):
+            pass
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del seen
+        print('{:20} {:>10,.0f} items/s  {:6.1f} MB per million keys  kept {:,} of {:,} unique'.format(
+            name, n / elapsed, size / unique, kept, unique))
+
+# Parallel dedupe over a process pool
+# Two rounds of work in the pool. First, chunks of items are turned into (key, seq)
+# pairs, where seq is the position of the item in the input, and each pair is sent to a
+# partition by the hash of its key. Then each partition keeps the first seq of every key.
+# The sorted seqs of all partitions are merged and the input is walked once more to emit
+# those items in their original order, so items must be iterable twice (a list, or an
+# object that reopens its file in __iter__). key may be a column name for dict rows; a
+# callable must be picklable (itemgetter or a module-level function, not a lambda).
+# The pairs and the kept seqs go through files in a temporary directory, so the parent
+# only holds the chunks in flight.
+#
+# hash() of a str is salted per process, and a worker started with the "spawn" method
+# gets its own salt, so partitions are picked with a hash that is the same everywhere.
+# Keys are limited to the types stable_hash() knows how to hash that way.
+import numbers
+import zlib
+
+def stable_hash(value):
+    if isinstance(value, str):
+        return zlib.crc32(value.encode('utf-8', 'surrogatepass'))
+    if isinstance(value, (bytes, bytearray)):
+        return zlib.crc32(value)
+    if isinstance(value, tuple):
+        h = 0x345678
+        for v in value:
+            h = (h * 1000003 ^ stable_hash(v)) & 0xFFFFFFFF
+        return h
+    if isinstance(value, numbers.Number):
+        return hash(value)          # Numbers hash the same way in every process
+    if value is None:
+        return 0x2F1D3C4B
+    if isinstance(value, frozenset):
+        h = 0x1B873593
+        for v in value:             # xor doesn't depend on the iteration order
+            h ^= (stable_hash(v) * 0x9E3779B1) & 0xFFFFFFFF
+        return h
+    raise TypeError('stable_hash() supports str, bytes, numbers, None and tuples or '
+                    'frozensets of them, not {}'.format(type(value).__name__))
+
+def partition_chunk(start, chunk, key, partitions, dirname):
+    parts = [[] for _ in range(partitions)]
+    for seq, item in enumerate(chunk, start):
+        val = item if key is None else key(item)
+        parts[stable_hash(val) % partitions].append((val, seq))
+    names = []
+    for n, part in enumerate(parts):
+        name = os.path.join(dirname, 'pairs{}-{}'.format(n, start))
+        with open(name, 'wb') as f:
+            pickle.dump(part, f, pickle.HIGHEST_PROTOCOL)
+        names.append(name)
+    return names
+
+def first_seen(names, filename):
+    seen = set()
+    first = array('q')
+    for name in names:              # In chunk order, so the first seq of a key wins
+        with open(name, 'rb') as f:
+            pairs = pickle.load(f)
+        os.remove(name)
+        for val, seq in pairs:
+            if val not in seen:
+                seen.add(val)
+                first.append(seq)
+    with open(filename, 'wb') as f:
+        first.tofile(f)
+    return filename
+
+def read_seqs(filename, batch=65536):
+    with open(filename, 'rb') as f:
+        while True:
+            seqs = array('q')
+            try:
+                seqs.fromfile(f, batch)
+            except EOFError:
+                pass                # The last, short batch is still read in
+            if not seqs:
+                return
+            yield from seqs
+
+def parallel_dedupe(items, key=None, workers=None, chunksize=100000, tempdir=None):
+    if iter(items) is items:
+        raise TypeError('parallel_dedupe() reads items twice; pass a list or another '
+                        're-iterable, not a {}'.format(type(items).__name__))
+    if isinstance(key, str):
+        key = itemgetter(key)
+    return _parallel_dedupe(items, key, workers or os.cpu_count(), chunksize, tempdir)
+
+def _parallel_dedupe(items, key, workers, chunksize, tempdir):
+    with tempfile.TemporaryDirectory(dir=tempdir) as dirname:
+        names = [[] for _ in range(workers)]
+        with ProcessPoolExecutor(workers) as pool:
+            def collect(future):
+                for part, name in zip(names, future.result()):
+                    part.append(name)
+            pending = deque()       # Bound the chunks in flight, and keep them in order
+            it = iter(items)
+            start = 0
+            while True:
+                chunk = list(islice(it, chunksize))
+                if not chunk:
+                    break
+                pending.append(pool.submit(partition_chunk, start, chunk, key, workers, dirname))
+                start += len(chunk)
+                if len(pending) > 2 * workers:
+                    collect(pending.popleft())
+            while pending:
+                collect(pending.popleft())
+            kept = list(pool.map(first_seen, names,
+                                 [os.path.join(dirname, 'kept{}'.format(n)) for n in range(workers)]))
+        keep = heapq.merge(*map(read_seqs, kept))
+        nxt = next(keep, None)
+        for seq, item in enumerate(items):
+            if seq == nxt:
+                yield item
+                nxt = next(keep, None)
+
+if __name__ == '__main__':
+    a = [{'x': 1, 'y': 2}, {'x': 1, 'y': 3}, {'x': 1, 'y': 2}, {'x': 2, 'y': 4}]
+    print(list(parallel_dedupe(a, key=itemgetter('x', 'y'), workers=2)))
+    print(list(parallel_dedupe(a, key='x', workers=2)))
+
+@benchmark(n=200000)
+def bench_parallel_dedupe(n=1000000, distinct=0.5):
+    import random
+    random.seed(0)
+    rows = [{'id': random.randrange(int(n * distinct)), 'value': i} for i in range(n)]
+    start = time.perf_counter()
+    expected = list(dedupe(rows, key=lambda r: r['id']))
+    print('dedupe()            {:>10,.0f} rows/s'.format(n / (time.perf_counter() - start)))
+    for workers in (1, 2, 4):
+        start = time.perf_counter()
+        result = list(parallel_dedupe(rows, key='id', workers=workers))
+        print('parallel_dedupe({}) {:>10,.0f} rows/s {}'.format(
+            workers, n / (time.perf_counter() - start), result == expected))
+
 
 # 1.11 Naming a Slice
 ######### 0123456789012345678901234567890123456789012345678901234567890'
@@ -381,6 +2472,149 @@ print(a.indices(len(s)))
 for i in range(*a.indices(len(s))):
     print(s[i])
 
+# Parsing whole fixed-width files by column
+# Declare the layout once with the named slices and a type per field. Each line of a
+# fixed-width file has the same length, so the mmap'd file is really a table of records.
+# With NumPy, a structured dtype with one fixed-width bytes field per slice is a zero-copy
+# view of the map, and astype() converts a whole column at once. Without NumPy, a field
+# is gathered with one strided slice per character position (m[start::reclen]), and the
+# resulting column of padded values is split() and converted by map(int, ...). No Python
+# code runs per line either way, and cost = shares * price is computed on whole columns.
+import operator
+
+class FixedWidthLayout:
+    _typecodes = {int: 'q', float: 'd'}
+
+    def __init__(self, **fields):
+        # fields: name=(slice, type), type is int, float or bytes
+        self.fields = sorted(fields.items(), key=lambda field: field[1][0].start)
+        pos = 0
+        for name, (sl, type_) in self.fields:
+            if sl.step not in (None, 1) or sl.start < pos:
+                raise ValueError('Field {!r} must be a contiguous, non-overlapping slice'.format(name))
+            if type_ not in (int, float, bytes):
+                raise ValueError('Field {!r} must be int, float or bytes'.format(name))
+            pos = sl.stop
+        self._end = pos
+
+    def parse_line(self, line):
+        return {name: type_(line[sl].strip()) for name, (sl, type_) in self.fields}
+
+    def parse_file(self, filename):
+        '''Return {name: column} for every field, as NumPy arrays or typed arrays'''
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return {name: [] if type_ is bytes else array(self._typecodes[type_])
+                        for name, (_, type_) in self.fields}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                reclen = m.find(b'\n') + 1 or len(m)
+                if reclen < self._end:
+                    raise ValueError('Records are {} bytes, layout needs {}'.format(reclen, self._end))
+                nrecs = len(m) // reclen
+                # Every record must end exactly where the first one does, or the columns
+                # would be cut out of the wrong bytes
+                ends = m[reclen - 1:nrecs * reclen:reclen]
+                tail = m[nrecs * reclen:]
+                if ends.count(b'\n') != nrecs or (b'\n' in tail and tail.strip()):
+                    bad = nrecs - len(ends.lstrip(b'\n'))
+                    raise ValueError('Record {} is not {} bytes long'.format(bad, reclen))
+                if np is not None:
+                    with memoryview(m) as view:     # Released before the map is closed
+                        columns = self._parse_numpy(view, reclen, nrecs)
+                else:
+                    columns = self._parse_strided(m, reclen, nrecs)
+                if tail.strip():                    # Last line without its newline
+                    last = self.parse_line(tail)
+                    for name, _ in self.fields:
+                        columns[name] = self._append(columns[name], last[name])
+                return columns
+
+    def _parse_strided(self, m, reclen, nrecs):
+        columns = {}
+        for name, (sl, type_) in self.fields:
+            width = sl.stop - sl.start
+            column = bytearray(width * nrecs)
+            for j in range(width):
+                column[j::width] = m[sl.start + j:nrecs * reclen:reclen]
+            values = column.split()
+            if len(values) != nrecs or type_ is bytes:
+                # Blank fields or embedded spaces: fall back to cutting every value out
+                values = [bytes(column[i:i + width]).strip() for i in range(0, len(column), width)]
+            columns[name] = values if type_ is bytes else array(self._typecodes[type_], map(type_, values))
+        return columns
+
+    def _parse_numpy(self, view, reclen, nrecs):
+        dtype = np.dtype({'names': [name for name, _ in self.fields],
+                          'formats': ['S{}'.format(sl.stop - sl.start) for _, (sl, _) in self.fields],
+                          'offsets': [sl.start for _, (sl, _) in self.fields],
+                          'itemsize': reclen})
+        records = np.frombuffer(view, dtype=dtype, count=nrecs)
+        columns = {}
+        try:
+            for name, (sl, type_) in self.fields:
+                if type_ is bytes:
+                    columns[name] = np.char.strip(records[name])
+                else:
+                    columns[name] = records[name].astype(np.int64 if type_ is int else np.float64)
+        except ValueError:
+            # A bad field: drop the view of the map, or the traceback keeps it exported
+            # and closing the memoryview fails with BufferError instead
+            del records
+            raise
+        return columns
+
+    @staticmethod
+    def _append(column, value):
+        if np is not None and isinstance(column, np.ndarray):
+            return np.append(column, value)
+        column.append(value)
+        return column
+
+def column_mul(a, b):
+    if np is not None and isinstance(a, np.ndarray):
+        return a * b
+    return array('d', map(operator.mul, a, b))
+
+layout = FixedWidthLayout(shares=(SHARES, int), price=(PRICE, float))
+print(layout.parse_line(record))
+with tempfile.TemporaryDirectory() as dirname:
+    filename = os.path.join(dirname, 'records.txt')
+    with open(filename, 'w') as f:
+        f.write(record + '\n')
+        f.write(record.replace('100 ', '200 ') + '\n')
+        f.write(record.replace('513.25', '  1.50'))
+    columns = layout.parse_file(filename)
+    print(list(columns['shares']), list(columns['price']), math.fsum(column_mul(columns['shares'], columns['price'])))
+
+@benchmark(n=200000)
+def bench_fixed_width(n=1000000):
+    import random
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'records.txt')
+        with open(filename, 'w') as f:
+            for _ in range(n):
+                f.write('{:20}{:<12d}{:8}{:8.2f}{:14}\n'.format('', random.randrange(1, 10000), '',
+                                                               random.uniform(1, 999), ''))
+        start = time.perf_counter()
+        total = 0.0
+        with open(filename) as f:
+            for line in f:
+                total += int(line[SHARES]) * float(line[PRICE])
+        t_lines = time.perf_counter() - start
+
+        start = time.perf_counter()
+        columns = layout.parse_file(filename)
+        t_parse = time.perf_counter() - start
+        start = time.perf_counter()
+        cost = math.fsum(column_mul(columns['shares'], columns['price']))
+        t_cost = time.perf_counter() - start
+        same = math.isclose(cost, total)
+    print('{:,} records'.format(n))
+    print('per-line slices + int()/float() : {:.3f}s'.format(t_lines))
+    print('parse_file() ({})          : {:.3f}s + {:.3f}s cost  {}'.format(
+        'numpy' if np is not None else 'strided', t_parse, t_cost, same))
+
 
 # 1. 12 Determining the Most Frequently Occurring Items in a Sequence
 # Counter(), most_common()
@@ -420,6 +2654,440 @@ print(c)
 d = a - b    # Subtract counts
 print(d)
 
+# Bounded-memory heavy hitters
+# Counter() keeps every distinct item. SpaceSaving keeps only `capacity` counters: an
+# unseen item takes over the smallest counter and inherits its count as its error, so
+# every count is an overestimate by at most total/capacity, and any item occurring more
+# than total/capacity times is guaranteed to be kept. CountMinSketch answers point
+# queries for any item from a depth x width table of counters (overestimate by at most
+# total*e/width with probability 1 - exp(-depth)) and tracks its own top candidates.
+# Both count chunks of the input with Counter() first, and both merge with +, so
+# sketches built by separate workers can be combined. Counts only grow, so the heaps
+# of (count, item) pairs can be refreshed lazily when a stale minimum surfaces.
+def _chunked_counts(iterable, chunksize=10000):
+    if isinstance(iterable, Mapping):
+        yield iterable
+        return
+    it = iter(iterable)
+    while True:
+        counts = Counter(islice(it, chunksize))
+        if not counts:
+            return
+        yield counts
+
+def _pop_smallest(heap, counts):
+    # Pop the heap entry for the item with the smallest current count
+    while True:
+        count, item = heap[0]
+        current = counts[item]
+        if count == current:
+            return heapq.heappop(heap)
+        heapq.heapreplace(heap, (current, item))
+
+class SpaceSaving:
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.total = 0
+        self._counts = {}
+        self._errors = {}
+        self._heap = []
+
+    def update(self, iterable):
+        counts, errors, heap = self._counts, self._errors, self._heap
+        for chunk in _chunked_counts(iterable):
+            for item, n in chunk.items():
+                self.total += n
+                if item in counts:
+                    counts[item] += n
+                elif len(counts) < self.capacity:
+                    counts[item] = n
+                    errors[item] = 0
+                    heapq.heappush(heap, (n, item))
+                else:
+                    smallest, victim = _pop_smallest(heap, counts)
+                    del counts[victim], errors[victim]
+                    counts[item] = smallest + n
+                    errors[item] = smallest
+                    heapq.heappush(heap, (smallest + n, item))
+
+    def _floor(self):
+        # Upper bound on the count of any item that is not monitored
+        if len(self._counts) < self.capacity:
+            return 0
+        return min(self._counts.values())
+
+    def __getitem__(self, item):
+        return self._counts.get(item, 0)
+
+    def __contains__(self, item):
+        return item in self._counts
+
+    def __len__(self):
+        return len(self._counts)
+
+    def bounds(self, item):
+        '''(lower, upper) bounds on the true count of item'''
+        if item in self._counts:
+            count = self._counts[item]
+            return count - self._errors[item], count
+        return 0, self._floor()
+
+    def most_common(self, n=None):
+        items = ((item, count) for item, count in self._counts.items())
+        if n is None:
+            return sorted(items, key=itemgetter(1), reverse=True)
+        return heapq.nlargest(n, items, key=itemgetter(1))
+
+    def guaranteed(self, n=None):
+        '''The most_common() items whose lower bound beats every other upper bound'''
+        top = self.most_common(n)
+        rest = [count for item, count in self.most_common()[len(top):]]
+        threshold = max(rest[0] if rest else 0, self._floor())
+        return [(item, count) for item, count in top
+                if count - self._errors[item] >= threshold]
+
+    def __add__(self, other):
+        if not isinstance(other, SpaceSaving):
+            return NotImplemented
+        # An item missing from one summary may still have occurred up to its floor times
+        floor_a, floor_b = self._floor(), other._floor()
+        merged = SpaceSaving(max(self.capacity, other.capacity))
+        merged.total = self.total + other.total
+        counts, errors = {}, {}
+        for item in self._counts.keys() | other._counts.keys():
+            counts[item] = self._counts.get(item, floor_a) + other._counts.get(item, floor_b)
+            errors[item] = self._errors.get(item, floor_a) + other._errors.get(item, floor_b)
+        for item, count in heapq.nlargest(merged.capacity, counts.items(), key=itemgetter(1)):
+            merged._counts[item] = count
+            merged._errors[item] = errors[item]
+        merged._heap = [(count, item) for item, count in merged._counts.items()]
+        heapq.heapify(merged._heap)
+        return merged
+
+    def __repr__(self):
+        return 'SpaceSaving({!r})'.format(dict(self.most_common(10)))
+
+class CountMinSketch:
+    def __init__(self, width=2719, depth=5, top=100):
+        self.width = width
+        self.depth = depth
+        self.top = top
+        self.total = 0
+        self._rows = [array('q', bytes(8 * width)) for _ in range(depth)]
+        self._top = {}
+        self._heap = []
+
+    @classmethod
+    def from_error(cls, epsilon=0.001, delta=0.01, top=100):
+        '''Overestimate by at most epsilon*total, with probability 1 - delta'''
+        return cls(math.ceil(math.e / epsilon), math.ceil(math.log(1 / delta)), top)
+
+    def _columns(self, item):
+        # Double hashing from stable_hash(), so sketches from other processes line up
+        h = stable_hash(item) & 0xFFFFFFFFFFFFFFFF
+        h1 = (h * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h2 = (((h ^ (h >> 31)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF) | 1
+        width = self.width
+        return [(h1 + i * h2) % width for i in range(self.depth)]
+
+    def _estimate(self, columns):
+        return min(row[col] for row, col in zip(self._rows, columns))
+
+    def __getitem__(self, item):
+        return self._estimate(self._columns(item))
+
+    def update(self, iterable):
+        rows, top, heap = self._rows, self._top, self._heap
+        for chunk in _chunked_counts(iterable):
+            for item, n in chunk.items():
+                self.total += n
+                columns = self._columns(item)
+                for row, col in zip(rows, columns):
+                    row[col] += n
+                self._offer(item, self._estimate(columns))
+
+    def _offer(self, item, estimate):
+        top, heap = self._top, self._heap
+        if item in top:
+            top[item] = estimate
+        elif len(top) < self.top:
+            top[item] = estimate
+            heapq.heappush(heap, (estimate, item))
+        elif estimate > heap[0][0]:
+            smallest, victim = _pop_smallest(heap, top)
+            if estimate > smallest:
+                del top[victim]
+                top[item] = estimate
+                heapq.heappush(heap, (estimate, item))
+            else:
+                heapq.heappush(heap, (smallest, victim))
+
+    def most_common(self, n=None):
+        items = self._top.items()
+        if n is None:
+            return sorted(items, key=itemgetter(1), reverse=True)
+        return heapq.nlargest(n, items, key=itemgetter(1))
+
+    def __add__(self, other):
+        if not isinstance(other, CountMinSketch):
+            return NotImplemented
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('Can only add sketches with the same width and depth')
+        merged = CountMinSketch(self.width, self.depth, max(self.top, other.top))
+        merged.total = self.total + other.total
+        for row, a, b in zip(merged._rows, self._rows, other._rows):
+            row[:] = array('q', map(operator.add, a, b))
+        for item in self._top.keys() | other._top.keys():
+            merged._offer(item, merged[item])
+        return merged
+
+    def nbytes(self):
+        return self.width * self.depth * 8
+
+    def __repr__(self):
+        return 'CountMinSketch(width={}, depth={}, total={})'.format(self.width, self.depth, self.total)
+
+top_words = SpaceSaving(capacity=5)
+top_words.update(words)
+print(top_words.most_common(3))
+print(top_words.bounds('eyes'), top_words.bounds('why'))
+sketch = CountMinSketch(width=64, depth=4, top=5)
+sketch.update(words)
+sketch.update(morewords)
+print(sketch['eyes'], sketch.most_common(3))
+more_words = SpaceSaving(capacity=5)
+more_words.update(morewords)
+print((top_words + more_words).most_common(3))
+
+@benchmark(n=200000, vocabulary=50000)
+def bench_heavy_hitters(n=1000000, vocabulary=200000, workers=4):
+    import random
+    import tracemalloc
+    random.seed(0)
+    # Zipf-like query log
+    weights = [1 / rank for rank in range(1, vocabulary + 1)]
+    stream = ['term{}'.format(i) for i in random.choices(range(vocabulary), weights, k=n)]
+    start = time.perf_counter()
+    exact = Counter(stream)
+    t_counter = time.perf_counter() - start
+    tracemalloc.start()
+    Counter(stream)
+    m_counter = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    expected = exact.most_common(10)
+    print('{:,} items, {:,} distinct'.format(n, len(exact)))
+    print('Counter          : {:.3f}s {:>12,} bytes'.format(t_counter, m_counter))
+
+    step = n // workers
+    parts = [stream[i:i + step] for i in range(0, n, step)]
+    for name, make in [('SpaceSaving', lambda: SpaceSaving(capacity=2000)),
+                       ('CountMinSketch', lambda: CountMinSketch.from_error(0.0005, 0.01, top=100))]:
+        def build():
+            merged = None
+            for part in parts:
+                sketch = make()
+                sketch.update(part)
+                merged = sketch if merged is None else merged + sketch
+            return merged
+        start = time.perf_counter()
+        merged = build()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        build()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        found = merged.most_common(10)
+        hits = len({item for item, _ in found} & {item for item, _ in expected})
+        worst = max(count - exact[item] for item, count in found)
+        bound = n / merged.capacity if name == 'SpaceSaving' else n * math.e / merged.width
+        print('{:<15}  : {:.3f}s {:>12,} bytes  top-10 recall {}/10, max overestimate {} (bound {:.0f})'.format(
+            name, elapsed, peak, hits, worst, bound))
+
+# Parallel map-reduce word counts
+# Each file is split into byte ranges, nudged forward to whitespace so that no word is
+# cut in two. A worker process counts the words in its range and returns them against
+# an interned vocabulary: a list of words plus an array('q') of counts, ids being list
+# positions. All workers start from the same seed vocabulary (the most common words of
+# a sample of the input), so the ids of the frequent words agree everywhere and the
+# reduce step is an elementwise array addition. Only the words a worker added beyond
+# the seed are looked up in a dict. WordCounts reads like a Counter.
+class WordCounts:
+    def __init__(self, vocab=(), counts=None):
+        self.vocab = list(vocab)
+        self.index = {word: i for i, word in enumerate(self.vocab)}
+        self.counts = array('q', counts) if counts is not None else array('q', bytes(8 * len(self.vocab)))
+
+    def __getitem__(self, word):
+        i = self.index.get(word)
+        return 0 if i is None else self.counts[i]
+
+    def __contains__(self, word):
+        return self[word] > 0
+
+    def __iter__(self):
+        return (word for word, count in zip(self.vocab, self.counts) if count)
+
+    def __len__(self):
+        return len(self.counts) - self.counts.count(0)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return ((word, count) for word, count in zip(self.vocab, self.counts) if count)
+
+    def total(self):
+        total = 0
+        for count in self.counts:
+            total += count
+        return total
+
+    def most_common(self, n=None):
+        if n is None:
+            return sorted(self.items(), key=itemgetter(1), reverse=True)
+        top = column_top(n, self.counts)
+        return [(self.vocab[i], self.counts[i]) for i in top if self.counts[i]]
+
+    def update(self, iterable):
+        for word, n in (iterable.items() if isinstance(iterable, Mapping) else Counter(iterable).items()):
+            self._add_word(word, n)
+
+    def _add_word(self, word, n):
+        i = self.index.get(word)
+        if i is None:
+            self.index[word] = len(self.vocab)
+            self.vocab.append(word)
+            self.counts.append(n)
+        else:
+            self.counts[i] += n
+
+    def add_counts(self, counts, shared, extra):
+        '''Add counts: the first shared are for self.vocab[:shared], the rest for extra'''
+        if shared:
+            self._add_shared(counts, shared)
+        for word, n in zip(extra, counts[shared:]):
+            self._add_word(word, n)
+
+    def _add_shared(self, counts, shared):
+        # The NumPy view of self.counts must be gone before _add_word() appends to it
+        if np is not None:
+            total = np.frombuffer(self.counts, dtype=np.int64)
+            total[:shared] += np.frombuffer(counts, dtype=np.int64, count=shared)
+        else:
+            self.counts[:shared] = array('q', map(operator.add, self.counts[:shared], counts[:shared]))
+
+    def __add__(self, other):
+        if not isinstance(other, WordCounts):
+            return NotImplemented
+        shared = 0
+        for mine, theirs in zip(self.vocab, other.vocab):
+            if mine != theirs:
+                break
+            shared += 1
+        result = WordCounts(self.vocab, self.counts)
+        result.add_counts(other.counts, shared, other.vocab[shared:])
+        return result
+
+    def to_counter(self):
+        return Counter(dict(self.items()))
+
+    def __repr__(self):
+        return 'WordCounts({!r})'.format(dict(self.most_common(10)))
+
+WORD_PATTERN = r"[\w']+"
+_whitespace = re.compile(rb'\s')
+_seed_vocab = ()
+
+def _set_seed_vocab(vocab):
+    global _seed_vocab
+    _seed_vocab = vocab
+
+def _align(m, pos):
+    # Move pos forward to the next whitespace, unless it already starts a word
+    if pos == 0 or pos >= len(m) or m[pos - 1:pos].isspace():
+        return pos
+    match = _whitespace.search(m, pos)
+    return match.start() if match else len(m)
+
+def count_range(filename, start, end, pattern=WORD_PATTERN):
+    '''Count the words in bytes [start, end) of filename, as (counts, shared, extra)'''
+    text = ''
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                text = m[_align(m, start):_align(m, end)].decode('utf-8', 'replace')
+    words = Counter(re.findall(pattern, text))
+    # Seed words first, in seed order, popped so that only the extra words are left
+    counts = array('q', map(words.pop, _seed_vocab, repeat(0)))
+    counts.extend(words.values())
+    return counts, len(_seed_vocab), list(words)
+
+def byte_ranges(filenames, chunksize):
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        for start in range(0, size or 1, chunksize):
+            yield filename, start, min(start + chunksize, size)
+
+a = WordCounts(['the', 'eyes', 'look'], [5, 8, 4])
+b = WordCounts(['the', 'eyes', 'my', 'under'], [1, 1, 3, 1])      # Diverges after 'eyes'
+c = WordCounts(['why', 'are', 'you'], [1, 1, 1])                   # Nothing in common with a
+print((a + b).to_counter() == a.to_counter() + b.to_counter(),
+      (a + c + b).to_counter() == a.to_counter() + b.to_counter() + c.to_counter(),
+      (a + c + b).most_common(3))
+
+def seed_vocab(filename, pattern=WORD_PATTERN, sample=1 << 20, limit=50000):
+    with open(filename, 'rb') as f:
+        text = f.read(sample).decode('utf-8', 'replace')
+    return [word for word, _ in Counter(re.findall(pattern, text)).most_common(limit)]
+
+def parallel_word_count(filenames, workers=None, chunksize=1 << 24, pattern=WORD_PATTERN):
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    seed = seed_vocab(filenames[0], pattern) if filenames else []
+    result = WordCounts(seed)
+    ranges = list(byte_ranges(filenames, chunksize))
+    with ProcessPoolExecutor(workers, initializer=_set_seed_vocab, initargs=(seed,)) as pool:
+        parts = pool.map(count_range, *zip(*ranges), repeat(pattern)) if ranges else ()
+        for counts, shared, extra in parts:
+            result.add_counts(counts, shared, extra)
+    return result
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'words.txt')
+        with open(filename, 'w') as f:
+            f.write(' '.join(words) + '\n' + ' '.join(morewords) + '\n')
+        wc = parallel_word_count(filename, workers=2, chunksize=16)
+        print(wc.most_common(3), wc['eyes'])
+        print(wc.to_counter() == Counter(words) + Counter(morewords))
+
+@benchmark(n=1000000, vocabulary=50000)
+def bench_word_count(n=10000000, vocabulary=100000, workers=(1, 2, 4, 8)):
+    import random
+    random.seed(0)
+    weights = [1 / rank for rank in range(1, vocabulary + 1)]
+    terms = ['term{}'.format(i) for i in range(vocabulary)]
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'words.txt')
+        with open(filename, 'w') as f:
+            for i in range(0, n, 100000):
+                f.write(' '.join(random.choices(terms, weights, k=min(100000, n - i))))
+                f.write('\n')
+        size = os.path.getsize(filename)
+        start = time.perf_counter()
+        with open(filename) as f:
+            expected = Counter(re.findall(WORD_PATTERN, f.read()))
+        t_counter = time.perf_counter() - start
+        print('{:,} words, {:,} bytes, {} CPUs'.format(n, size, os.cpu_count()))
+        print('Counter(re.findall()), 1 process : {:.3f}s'.format(t_counter))
+        for w in workers:
+            start = time.perf_counter()
+            wc = parallel_word_count(filename, workers=w, chunksize=max(1 << 16, size // (2 * w)))
+            elapsed = time.perf_counter() - start
+            same = wc.most_common(20) == expected.most_common(20) and len(wc) == len(expected)
+            print('parallel_word_count, {} workers  : {:.3f}s  speedup {:.2f}x  {}'.format(
+                w, elapsed, t_counter / elapsed, same))
+
 # 1.13 Sorting a List of Dictionaries by a Common Key
 rows = [
  {'fname': 'Brian', 'lname': 'Jones', 'uid': 1003},
@@ -447,6 +3115,153 @@ print(sorted("This is at tost string from Andrew".split(), key=str.lower))
 print('min itemgetter:', min(rows, key=itemgetter('uid')))
 print('max itemgetter:', max(rows, key=itemgetter('uid')))
 
+# Sorting more rows than fit in memory
+# external_sorted() takes the same key functions as sorted() (itemgetter('lname', 'fname'),
+# attrgetter(...), a lambda), and reverse can be a tuple with one flag per key field.
+# Rows are cut into runs of run_size, and each run is sorted by (key, row) pairs in a
+# worker process and written as a binary file of pickled batches. The runs are then
+# streamed back through large read buffers and merged with heapq.merge(), at most fanin
+# at a time. Both sorted() and heapq.merge() are stable, and runs are merged in input
+# order, so rows with equal keys keep their order. Descending fields are negated when
+# they are numbers and wrapped in _Reversed otherwise.
+class _Reversed:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __reduce__(self):
+        return _Reversed, (self.value,)
+
+class _SortKey:
+    # Puts every field in ascending order. A class rather than a closure, so that it
+    # can be pickled and sent to worker processes.
+    def __init__(self, key, reverse):
+        self.key = key
+        self.reverse = reverse
+
+    def __call__(self, row):
+        value = row if self.key is None else self.key(row)
+        if self.reverse is False:
+            return value
+        fields = value if isinstance(value, tuple) else (value,)
+        flags = self.reverse if isinstance(self.reverse, tuple) else (self.reverse,) * len(fields)
+        out = tuple((-v if isinstance(v, (int, float)) else _Reversed(v)) if flag else v
+                    for v, flag in zip(fields, flags))
+        return out if isinstance(value, tuple) else out[0]
+
+def _write_run(filename, pairs, batch):
+    with open(filename, 'wb') as f:
+        for i in range(0, len(pairs), batch):
+            pickle.dump(pairs[i:i + batch], f, pickle.HIGHEST_PROTOCOL)
+    return filename
+
+def sort_run(filename, rows, key, batch=1024):
+    '''Sort rows by key into a run file of (key, row) batches'''
+    pairs = list(zip(map(key, rows), rows))
+    pairs.sort(key=itemgetter(0))
+    return _write_run(filename, pairs, batch)
+
+def read_run(filename, buffer_size=1 << 20):
+    with open(filename, 'rb', buffering=buffer_size) as f:
+        while True:
+            try:
+                yield from pickle.load(f)
+            except EOFError:
+                return
+
+def _merge_runs(filenames, buffer_size):
+    return heapq.merge(*(read_run(name, buffer_size) for name in filenames), key=itemgetter(0))
+
+def external_sorted(iterable, key=None, reverse=False, run_size=100000, workers=None,
+                    tempdir=None, fanin=64, buffer_size=1 << 20, batch=1024):
+    '''Like sorted(), but keeps at most about run_size rows (per worker) in memory.
+    With workers=0, runs are sorted in this process and key need not be picklable.'''
+    key = key if key is not None and reverse is False else _SortKey(key, reverse)
+    it = iter(iterable)
+    chunk = list(islice(it, run_size))
+    if len(chunk) < run_size:                   # Fits in memory
+        chunk.sort(key=key)
+        yield from chunk
+        return
+    with tempfile.TemporaryDirectory(dir=tempdir) as dirname:
+        names = (os.path.join(dirname, 'run{}'.format(n)) for n in count())
+        runs = []
+        if workers == 0:
+            while chunk:
+                runs.append(sort_run(next(names), chunk, key, batch))
+                chunk = list(islice(it, run_size))
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                pending = deque()               # Bound the runs held in memory
+                limit = 2 * (workers or os.cpu_count())
+                while chunk:
+                    pending.append(pool.submit(sort_run, next(names), chunk, key, batch))
+                    if len(pending) >= limit:
+                        runs.append(pending.popleft().result())
+                    chunk = list(islice(it, run_size))
+                runs.extend(future.result() for future in pending)
+        # Merge fanin runs at a time until one final merge remains
+        while len(runs) > fanin:
+            merged = []
+            for i in range(0, len(runs), fanin):
+                group = runs[i:i + fanin]
+                pairs = _merge_runs(group, buffer_size)
+                name = next(names)
+                with open(name, 'wb') as f:
+                    while True:
+                        part = list(islice(pairs, batch))
+                        if not part:
+                            break
+                        pickle.dump(part, f, pickle.HIGHEST_PROTOCOL)
+                for run in group:
+                    os.remove(run)
+                merged.append(name)
+            runs = merged
+        for _, row in _merge_runs(runs, buffer_size):
+            yield row
+
+print(list(external_sorted(rows, key=itemgetter('lname', 'fname'), run_size=2, workers=0)))
+print(list(external_sorted(rows, key=itemgetter('lname', 'fname'), reverse=(False, True),
+                           run_size=2, workers=0)))
+
+if __name__ == '__main__':
+    print([row['uid'] for row in external_sorted(rows, key=itemgetter('uid'), reverse=True,
+                                                 run_size=2, workers=2)])
+
+@benchmark(n=200000, run_size=20000)
+def bench_external_sort(n=1000000, run_size=100000, workers=None):
+    import random
+    random.seed(0)
+    names = ['Jones', 'Beazley', 'Cleese', 'Smith', 'Brown', 'Lee', 'Wilson', 'Taylor']
+    data = [{'fname': 'F{}'.format(random.randrange(1000)), 'lname': random.choice(names),
+             'uid': i} for i in range(n)]
+    key = itemgetter('lname', 'fname')
+    start = time.perf_counter()
+    expected = sorted(data, key=key)
+    t_sorted = time.perf_counter() - start
+    print('{:,} rows, runs of {:,}'.format(n, run_size))
+    print('sorted(), in memory          : {:.3f}s'.format(t_sorted))
+    for label, w in [('in process', 0), ('{} workers'.format(workers or os.cpu_count()), workers)]:
+        start = time.perf_counter()
+        result = list(external_sorted(data, key=key, run_size=run_size, workers=w))
+        elapsed = time.perf_counter() - start
+        print('external_sorted(), {:<10} : {:.3f}s  {}'.format(label, elapsed, result == expected))
+    start = time.perf_counter()
+    expected = sorted(data, key=lambda r: (r['lname'], _Reversed(r['fname'])))
+    t_sorted = time.perf_counter() - start
+    start = time.perf_counter()
+    result = list(external_sorted(data, key=key, reverse=(False, True), run_size=run_size, workers=0))
+    elapsed = time.perf_counter() - start
+    print('lname asc, fname desc        : {:.3f}s sorted(), {:.3f}s external  {}'.format(
+        t_sorted, elapsed, result == expected))
+
 
 # 1.14 Sorting Objects Without Native Comparison Support
 class User:
@@ -460,6 +3275,111 @@ print(users)
 print(sorted(users, key=attrgetter('user_id')))
 print(sorted(users, key=lambda u: u.user_id))
 
+# Sorting by key columns instead of per-row key calls
+# sorted(rows, key=itemgetter('lname', 'fname')) builds and compares a tuple for every
+# row. column_sorted() pulls each key field out once with map(itemgetter(field), rows),
+# and factorize() replaces every column by the ranks of its values among the sorted
+# distinct values, so strings are compared once per distinct value, not once per row.
+# argsort_columns() combines the rank columns into one integer per row (mixed radix,
+# with descending fields flipped), sorts the row numbers by it, and the permutation is
+# applied to the rows. A single key column is used as is. With NumPy, np.unique() and
+# np.lexsort() do the same in C, for the columns NumPy can hold without changing them.
+def _numpy_column(values):
+    '''values as a 1-D numeric or string array, or None if NumPy can't hold them as they are'''
+    if isinstance(values, np.ndarray):
+        column = values
+    else:
+        try:
+            column = np.asarray(values)
+        except ValueError:              # Tuples of different lengths
+            return None
+    if column.ndim != 1 or column.dtype.kind not in 'biufSU':
+        return None
+    # Mixed ints and strs all become strs, big ints next to floats lose digits, and
+    # trailing NULs are dropped: any of those and the round trip doesn't match
+    if column is not values and column.tolist() != list(values):
+        return None
+    return column
+
+def factorize(values):
+    '''Return (codes, uniques), codes[i] being the rank of values[i] in uniques'''
+    if np is not None:
+        column = _numpy_column(values)
+        if column is not None:
+            uniques, codes = np.unique(column, return_inverse=True)
+            return codes, uniques.tolist()
+    uniques = sorted(set(values))
+    index = {value: code for code, value in enumerate(uniques)}
+    codes = array('q', map(index.__getitem__, values))
+    return (codes if np is None else np.asarray(codes)), uniques
+
+def argsort_columns(columns, reverse=False):
+    '''Row order for sorting by columns[0], then columns[1], ... (a stable sort)'''
+    if not columns:
+        raise ValueError('At least one column is required')
+    flags = reverse if isinstance(reverse, tuple) else (reverse,) * len(columns)
+    if len(columns) == 1 and np is None:
+        # One column needs no ranks, its values are the keys
+        column = columns[0]
+        return sorted(range(len(column)), key=column.__getitem__, reverse=flags[0])
+    keys = []
+    for column, flag in zip(columns, flags):
+        codes, uniques = factorize(column)
+        if flag:                                # Flip the ranks for descending order
+            codes = (len(uniques) - 1 - codes if np is not None else
+                     array('q', map(operator.sub, repeat(len(uniques) - 1), codes)))
+        keys.append((codes, len(uniques)))
+    if np is not None:
+        return np.lexsort([codes for codes, _ in reversed(keys)]).tolist()
+    composite, _ = keys[0]
+    for codes, size in keys[1:]:
+        composite = map(operator.add, map(operator.mul, composite, repeat(size)), codes)
+    if len(keys) > 1:
+        # More combinations than 64 bits can hold leaves the keys as Python ints
+        composite = array('q', composite) if math.prod(size for _, size in keys) < 1 << 63 else list(composite)
+    return sorted(range(len(composite)), key=composite.__getitem__)
+
+def column_sorted(records, *fields, getter=itemgetter, reverse=False):
+    '''sorted(records, key=getter(*fields)), with reverse per field allowed'''
+    records = records if isinstance(records, (list, tuple)) else list(records)
+    if not records:
+        return []
+    columns = [list(map(getter(field), records)) for field in fields]
+    return list(map(records.__getitem__, argsort_columns(columns, reverse)))
+
+print(column_sorted(rows, 'lname', 'fname'))
+print(column_sorted(rows, 'lname', 'uid', reverse=(False, True)))
+print(column_sorted(users, 'user_id', getter=attrgetter))
+
+@benchmark(n=200000)
+def bench_column_sort(n=1000000):
+    import random
+    random.seed(0)
+    lnames = ['Jones', 'Beazley', 'Cleese', 'Smith', 'Brown', 'Lee', 'Wilson', 'Taylor']
+    data = [{'fname': 'F{}'.format(random.randrange(5000)), 'lname': random.choice(lnames),
+             'uid': random.randrange(10 * n)} for i in range(n)]
+    objects = [User(random.randrange(10 * n)) for _ in range(n)]
+    cases = [
+        ("itemgetter('uid')", lambda: sorted(data, key=itemgetter('uid')),
+         lambda: column_sorted(data, 'uid')),
+        ("itemgetter('lname', 'fname')", lambda: sorted(data, key=itemgetter('lname', 'fname')),
+         lambda: column_sorted(data, 'lname', 'fname')),
+        ("lambda r: (r['lname'], r['fname'])", lambda: sorted(data, key=lambda r: (r['lname'], r['fname'])),
+         lambda: column_sorted(data, 'lname', 'fname')),
+        ("attrgetter('user_id')", lambda: sorted(objects, key=attrgetter('user_id')),
+         lambda: column_sorted(objects, 'user_id', getter=attrgetter)),
+    ]
+    print('{:,} rows'.format(n))
+    for label, by_key, by_columns in cases:
+        start = time.perf_counter()
+        expected = by_key()
+        t_key = time.perf_counter() - start
+        start = time.perf_counter()
+        result = by_columns()
+        t_columns = time.perf_counter() - start
+        print('{:<36}: sorted() {:.3f}s  column_sorted() {:.3f}s  {}'.format(
+            label, t_key, t_columns, result == expected))
+
 
 # 1.15 Grouping Records Together Based on a Field : itertools.groupby()
 from operator import itemgetter
@@ -495,6 +3415,334 @@ for r in rows_by_date['07/01/2012']:
 
 print(rows_by_date)
 
+# Group-by without sorting: hash aggregation
+# hash_groupby() keeps one list of running aggregates per key instead of the rows
+# themselves, so it needs neither the sort that groupby() does nor the lists of rows in
+# rows_by_date. Aggregates are given as name=(how, field), how being 'count', 'sum',
+# 'min', 'max', 'first', 'last' or a pair of functions (start(value), step(state, value)).
+# When more than max_groups keys are in memory, rows with keys that are not already in
+# the table are written to partition files on disk, by hash of the key. Keys in memory
+# keep every one of their rows and spilled keys keep every one of theirs, so 'first' and
+# 'last' stay right. Each partition is then aggregated the same way, one at a time.
+_aggregators = {
+    'count': (lambda value: 1, lambda state, value: state + 1),
+    'sum': (lambda value: value, operator.add),
+    'min': (lambda value: value, min),
+    'max': (lambda value: value, max),
+    'first': (lambda value: value, lambda state, value: state),
+    'last': (lambda value: value, lambda state, value: value),
+}
+
+def hash_groupby(rows, key, max_groups=1000000, partitions=16, tempdir=None, **aggregates):
+    '''Yield (key, {name: aggregate}) for every distinct key, in no particular order'''
+    # Fewer would spill forever: no room for even one group, or every row in one partition
+    if max_groups < 1:
+        raise ValueError('max_groups must be at least 1')
+    if partitions < 2:
+        raise ValueError('partitions must be at least 2')
+    starts, steps, fields = [], [], []
+    for name, spec in aggregates.items():
+        how, field = spec if isinstance(spec, tuple) else (spec, None)
+        start, step = _aggregators[how] if isinstance(how, str) else how
+        starts.append(start)
+        steps.append(step)
+        # 'count' ignores its value, so any field will do
+        fields.append(key if field is None and isinstance(key, str) else field)
+    if all(isinstance(field, str) for field in fields) and len(fields) > 1:
+        values = itemgetter(*fields)            # One C call per row for all the values
+    else:
+        getters = [itemgetter(field) if isinstance(field, str) else field or (lambda row: None)
+                   for field in fields]
+        values = lambda row: [get(row) for get in getters]
+    if isinstance(key, str):
+        key = itemgetter(key)
+    names = list(aggregates)
+    yield from _hash_aggregate(rows, key, values, names, starts, steps,
+                               max_groups, partitions, tempdir, 0)
+
+def _hash_aggregate(rows, key, values, names, starts, steps, max_groups, partitions, tempdir, level):
+    table = {}
+    spilled = None
+    for row in rows:
+        k = key(row)
+        vals = values(row)
+        state = table.get(k)
+        if state is not None:
+            i = 0
+            for step, value in zip(steps, vals):
+                state[i] = step(state[i], value)
+                i += 1
+        elif len(table) < max_groups:
+            table[k] = [start(value) for start, value in zip(starts, vals)]
+        else:
+            if spilled is None:
+                spilled = _Partitions(partitions, tempdir, level)
+            spilled.add(k, vals)
+    for k, state in table.items():
+        yield k, dict(zip(names, state))
+    del table
+    if spilled is not None:
+        with spilled:
+            for part in spilled.read():
+                yield from _hash_aggregate(part, itemgetter(0), itemgetter(1), names, starts, steps,
+                                           max_groups, partitions, tempdir, level + 1)
+
+class _Partitions:
+    # (key, values) pairs spilled to disk by hash of the key, in pickled batches
+    def __init__(self, partitions, tempdir, level, batch=1024):
+        self._dir = tempfile.TemporaryDirectory(dir=tempdir)
+        self._files = [open(os.path.join(self._dir.name, str(n)), 'w+b') for n in range(partitions)]
+        self._buffers = [[] for _ in range(partitions)]
+        self._level = level
+        self._batch = batch
+
+    def add(self, k, vals):
+        # The level changes the hash, so a partition with too many keys splits again
+        n = hash((self._level, k)) % len(self._files)
+        buffer = self._buffers[n]
+        buffer.append((k, vals))
+        if len(buffer) >= self._batch:
+            pickle.dump(buffer, self._files[n], pickle.HIGHEST_PROTOCOL)
+            buffer.clear()
+
+    def read(self):
+        for f, buffer in zip(self._files, self._buffers):
+            if buffer:
+                pickle.dump(buffer, f, pickle.HIGHEST_PROTOCOL)
+                buffer.clear()
+            f.seek(0)
+            yield self._read(f)
+
+    @staticmethod
+    def _read(f):
+        while True:
+            try:
+                yield from pickle.load(f)
+            except EOFError:
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for f in self._files:
+            f.close()
+        self._dir.cleanup()
+
+for date, agg in hash_groupby(rows, 'date', count='count', first=('first', 'address'),
+                              last=('last', 'address')):
+    print(date, agg)
+streets = (lambda address: {address.split()[-1]},
+           lambda names, address: names | {address.split()[-1]})
+print(dict(hash_groupby(rows, 'date', max_groups=2, partitions=2, streets=(streets, 'address'))))
+
+@benchmark(n=200000, keys=20000)
+def bench_groupby(n=1000000, keys=100000):
+    import random
+    random.seed(0)
+    data = [{'date': 'D{}'.format(random.randrange(keys)), 'shares': random.randrange(1000)}
+            for _ in range(n)]
+    def aggregate(group):
+        count = total = 0
+        lo = hi = None
+        for row in group:
+            shares = row['shares']
+            count += 1
+            total += shares
+            lo = shares if lo is None or shares < lo else lo
+            hi = shares if hi is None or shares > hi else hi
+        return {'count': count, 'total': total, 'lo': lo, 'hi': hi}
+    def by_sort():
+        ordered = sorted(data, key=itemgetter('date'))
+        return ((date, aggregate(group)) for date, group in groupby(ordered, key=itemgetter('date')))
+    def by_defaultdict():
+        groups = defaultdict(list)
+        for row in data:
+            groups[row['date']].append(row)
+        return ((date, aggregate(group)) for date, group in groups.items())
+    def by_hash(max_groups):
+        return hash_groupby(data, 'date', max_groups=max_groups, count='count',
+                            total=('sum', 'shares'), lo=('min', 'shares'), hi=('max', 'shares'))
+    import tracemalloc
+    print('{:,} rows, {:,} keys'.format(n, keys))
+    expected = None
+    for label, func in [('sort + groupby()', by_sort),
+                        ('defaultdict(list)', by_defaultdict),
+                        ('hash_groupby()', lambda: by_hash(keys)),
+                        ('hash_groupby(), spilling', lambda: by_hash(keys // 4))]:
+        start = time.perf_counter()
+        result = dict(func())
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        deque(func(), maxlen=0)                 # Memory used along the way, not by the result
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        expected = expected or result
+        print('{:<25}: {:.3f}s {:>12,} bytes peak  {}'.format(label, elapsed, peak, result == expected))
+
+# Keeping the indexes up to date: IndexedRecords
+# rows_by_date is built once and goes stale as soon as rows come and go. IndexedRecords
+# keeps every row under a record id and updates its indexes on insert() and remove():
+# a hash index maps a field value to the ids of its rows (a dict, so they stay in
+# insertion order), and a sorted index is a SortedList of (value, id) pairs that
+# range() walks between two bisections. find() starts from the smallest indexed match
+# and only checks the other criteria on those rows. Rows must not be changed while they
+# are in the collection.
+class IndexedRecords:
+    def __init__(self, rows=(), hash_fields=(), sorted_fields=(), getter=itemgetter):
+        self._rows = {}
+        self._ids = count()
+        self._getter = getter
+        self._getters = {field: getter(field) for field in set(hash_fields) | set(sorted_fields)}
+        self._hash = {field: {} for field in hash_fields}
+        self._sorted = {field: SortedList() for field in sorted_fields}
+        self.extend(rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        return iter(self._rows.values())
+
+    def __getitem__(self, rid):
+        return self._rows[rid]
+
+    def insert(self, row):
+        # Get every indexed value first, so a missing field or an unhashable value fails
+        # before anything has changed
+        getters = self._getters
+        hash_keys = [(index, getters[field](row)) for field, index in self._hash.items()]
+        for _, value in hash_keys:
+            hash(value)
+        sorted_keys = [(index, getters[field](row)) for field, index in self._sorted.items()]
+        rid = next(self._ids)
+        added = []
+        try:
+            for index, value in sorted_keys:
+                index.add((value, rid))     # Fails if value can't be ordered against the rest
+                added.append((index, value))
+        except Exception:
+            for index, value in added:
+                index.remove((value, rid))
+            raise
+        self._rows[rid] = row
+        for index, value in hash_keys:
+            index.setdefault(value, {})[rid] = None
+        return rid
+
+    def extend(self, rows):
+        for row in rows:
+            self.insert(row)
+
+    def remove(self, rid):
+        row = self._rows.pop(rid)
+        for field, index in self._hash.items():
+            value = self._getters[field](row)
+            ids = index[value]
+            del ids[rid]
+            if not ids:
+                del index[value]
+        for field, index in self._sorted.items():
+            index.remove((self._getters[field](row), rid))
+        return row
+
+    def _matching_ids(self, field, value):
+        if field in self._hash:
+            return self._hash[field].get(value, {})
+        return [rid for _, rid in self._sorted[field].irange((value,), (value, math.inf))]
+
+    def find(self, **criteria):
+        '''Rows whose fields equal all of criteria'''
+        rows = self._rows
+        indexed = [field for field in criteria if field in self._hash or field in self._sorted]
+        if indexed:
+            ids, field = min(((self._matching_ids(field, criteria[field]), field) for field in indexed),
+                             key=lambda match: len(match[0]))
+            candidates = [rows[rid] for rid in ids]
+            criteria = {name: value for name, value in criteria.items() if name != field}
+        else:                                   # Nothing to go on but a full scan
+            candidates = rows.values()
+        for field, value in criteria.items():
+            get = self._getters.get(field) or self._getter(field)
+            candidates = [row for row in candidates if get(row) == value]
+        return list(candidates)
+
+    def range(self, field, lo=None, hi=None):
+        '''Rows with lo <= field <= hi, ordered by field. Needs a sorted index on field.'''
+        index = self._sorted[field]
+        if lo is None:
+            pairs = iter(index)
+        else:
+            pairs = index.irange((lo,))
+        if hi is not None:
+            pairs = takewhile(lambda pair: pair[0] <= hi, pairs)
+        rows = self._rows
+        return [rows[rid] for _, rid in pairs]
+
+    def index_memory(self):
+        '''Bytes used by each index, not counting the rows and values themselves'''
+        usage = {}
+        for field, index in self._hash.items():
+            size = sys.getsizeof(index)
+            for ids in index.values():
+                size += sys.getsizeof(ids)
+            usage['hash:' + field] = size
+        for field, index in self._sorted.items():
+            size = sys.getsizeof(index._lists) + sys.getsizeof(index._maxes)
+            for sub in index._lists:
+                size += sys.getsizeof(sub)
+            for pair in index:
+                size += sys.getsizeof(pair)
+            usage['sorted:' + field] = size
+        return usage
+
+records = IndexedRecords(rows, hash_fields=['date'], sorted_fields=['date'])
+print(records.find(date='07/01/2012'))
+print(records.range('date', '07/02/2012', '07/03/2012'))
+rid = records.insert({'address': '1 N STATE', 'date': '07/01/2012'})
+print(len(records.find(date='07/01/2012')), records.remove(rid), len(records.find(date='07/01/2012')))
+print(records.index_memory())
+
+@benchmark(n=200000)
+def bench_indexed_records(n=1000000, queries=1000):
+    import random
+    random.seed(0)
+    data = [{'uid': i, 'date': '2012-{:02d}-{:02d}'.format(random.randint(1, 12), random.randint(1, 28)),
+             'shares': random.randrange(10000)} for i in range(n)]
+    start = time.perf_counter()
+    records = IndexedRecords(data, hash_fields=['date'], sorted_fields=['shares'])
+    t_build = time.perf_counter() - start
+    dates = [random.choice(data)['date'] for _ in range(queries)]
+    bounds = [(lo, lo + 10) for lo in (random.randrange(10000) for _ in range(queries))]
+    scans = max(1, queries // 100)              # Full scans are too slow to run them all
+
+    start = time.perf_counter()
+    for date in dates[:scans]:
+        expected = [row for row in data if row['date'] == date]
+    t_scan = (time.perf_counter() - start) / scans
+    start = time.perf_counter()
+    for date in dates:
+        found = records.find(date=date)
+    t_find = (time.perf_counter() - start) / queries
+    same = found == [row for row in data if row['date'] == dates[-1]]
+
+    start = time.perf_counter()
+    for lo, hi in bounds[:scans]:
+        expected = sorted((row for row in data if lo <= row['shares'] <= hi), key=itemgetter('shares'))
+    t_range_scan = (time.perf_counter() - start) / scans
+    start = time.perf_counter()
+    for lo, hi in bounds:
+        found = records.range('shares', lo, hi)
+    t_range = (time.perf_counter() - start) / queries
+    lo, hi = bounds[-1]
+    same = same and found == sorted((row for row in data if lo <= row['shares'] <= hi),
+                                    key=itemgetter('shares'))
+    print('{:,} rows, indexes built in {:.3f}s'.format(n, t_build))
+    print('equality: scan {:.2f} ms, find()  {:.3f} ms'.format(t_scan * 1e3, t_find * 1e3))
+    print('range   : scan {:.2f} ms, range() {:.3f} ms  {}'.format(t_range_scan * 1e3, t_range * 1e3, same))
+    for name, size in records.index_memory().items():
+        print('{:<14} {:>12,} bytes'.format(name, size))
+
 
 # 1.16 Filtering Sequence Elements
 mylist = [1, 4, -5, 10, -7, 2, 3, -1]
@@ -535,7 +3783,7 @@ addresses = [
  '5412 N CLARK',
  '5148 N CLARK',
  '5800 E 58TH',
- '2122 N CLARK'
+ '2122 N CLARK',
  '5645 N RAVENSWOOD',
  '1060 W ADDISON',
  '4801 N BROADWAY',
@@ -548,6 +3796,187 @@ more5 = [n > 5 for n in counts]
 print(more5)
 print(list(compress(addresses, more5)))
 
+# Filtering whole columns with masks
+# A Mask holds one byte per row (a NumPy bool array when NumPy is there), so comparing a
+# Column with a value, combining masks with & | ~ and counting them all run in C:
+# comparisons are map(operator.gt, values, repeat(value)), & and | are done on the mask
+# bytes as two big ints, and ~ is bytes.translate(). column[mask] applies a mask with
+# compress(); the same mask can select from any sibling column of the same length. A
+# mask that keeps a single contiguous run of rows becomes a slice (a view with NumPy),
+# and one that keeps everything returns the column itself.
+_flip = bytes.maketrans(b'\x00\x01', b'\x01\x00')
+
+class Mask:
+    def __init__(self, bits):
+        # bits: bytes of 0/1, or a NumPy bool array
+        self.bits = bits
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __iter__(self):
+        return map(bool, self.bits)
+
+    def count(self):
+        return int(np.count_nonzero(self.bits)) if np is not None else self.bits.count(1)
+
+    def _combine(self, other, op):
+        if len(self) != len(other):
+            raise ValueError('Masks have different lengths: {} and {}'.format(len(self), len(other)))
+        if np is not None:
+            return Mask(op(self.bits, other.bits))
+        a = int.from_bytes(self.bits, 'little')
+        b = int.from_bytes(other.bits, 'little')
+        return Mask(op(a, b).to_bytes(len(self.bits), 'little'))
+
+    def __and__(self, other):
+        return self._combine(other, operator.and_)
+
+    def __or__(self, other):
+        return self._combine(other, operator.or_)
+
+    def __invert__(self):
+        return Mask(~self.bits if np is not None else self.bits.translate(_flip))
+
+    def _run(self):
+        # (start, stop) if the mask keeps exactly one contiguous run of rows, else None
+        bits = self.bits
+        if np is not None:
+            kept = np.flatnonzero(bits)
+            if len(kept) and kept[-1] - kept[0] + 1 == len(kept):
+                return int(kept[0]), int(kept[-1]) + 1
+            return None
+        start = bits.find(1)
+        if start < 0:
+            return None
+        stop = bits.find(0, start)
+        stop = len(bits) if stop < 0 else stop
+        return (start, stop) if bits.find(1, stop) < 0 else None
+
+    def __repr__(self):
+        return 'Mask({})'.format(''.join('1' if bit else '0' for bit in self.bits))
+
+class Column:
+    def __init__(self, values):
+        if isinstance(values, Column):
+            values = values.values
+        elif np is not None:
+            values = np.asarray(values)
+        elif not isinstance(values, list):
+            values = list(values)               # Lists index faster than typed arrays
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def tolist(self):
+        return self.values.tolist() if np is not None else list(self.values)
+
+    def _compare(self, op, value):
+        if np is not None:
+            return Mask(op(self.values, value))
+        return Mask(bytes(map(op, self.values, repeat(value))))
+
+    def __lt__(self, value):
+        return self._compare(operator.lt, value)
+
+    def __le__(self, value):
+        return self._compare(operator.le, value)
+
+    def __gt__(self, value):
+        return self._compare(operator.gt, value)
+
+    def __ge__(self, value):
+        return self._compare(operator.ge, value)
+
+    def __eq__(self, value):
+        return self._compare(operator.eq, value)
+
+    def __ne__(self, value):
+        return self._compare(operator.ne, value)
+
+    __hash__ = None
+
+    def __getitem__(self, index):
+        if not isinstance(index, Mask):
+            return self.values[index]
+        if len(index) != len(self):
+            raise ValueError('Mask has {} rows, column has {}'.format(len(index), len(self)))
+        run = index._run()
+        if run is None:
+            if np is not None:
+                return Column(self.values[index.bits])
+            return Column(list(compress(self.values, index.bits)))
+        start, stop = run
+        if start == 0 and stop == len(self):
+            return self
+        return Column(self.values[start:stop])
+
+    def clip(self, lo=None, hi=None):
+        if np is not None:
+            return Column(np.clip(self.values, lo, hi))
+        # Faster than map(max, values, repeat(lo)), which calls max() for every value
+        values = self.values
+        if lo is not None:
+            values = [lo if value < lo else value for value in values]
+        if hi is not None:
+            values = [hi if value > hi else value for value in values]
+        return Column(values)
+
+    def __repr__(self):
+        return 'Column({!r})'.format(self.tolist())
+
+def compress_columns(mask, columns):
+    '''Apply mask to every column of a {name: column} dict'''
+    return {name: Column(column)[mask] for name, column in columns.items()}
+
+_int_pattern = re.compile(r'\s*[+-]?\d+(?:_\d+)*\s*')
+
+def is_int_mask(values):
+    '''Mask of the strings that int() would accept'''
+    matches = map(bool, map(_int_pattern.fullmatch, values))
+    return Mask(np.fromiter(matches, dtype=bool) if np is not None else bytes(matches))
+
+column = Column(mylist)
+print((column > 0), column[column > 0], column[(column > 0) & ~(column > 5)])
+print(column.clip(lo=0), column.clip(hi=0))
+print(Column(values)[is_int_mask(values)])
+print(compress_columns(Column(counts) > 5, {'address': addresses, 'count': counts}))
+
+@benchmark(n=200000)
+def bench_column_filter(n=1000000):
+    import random
+    random.seed(0)
+    data = [random.randint(-1000, 1000) for _ in range(n)]
+    strings = [random.choice(['1', '-23', 'N/A', '-', '4.5', ' 7 ', '']) for _ in range(n)]
+    names = ['A{}'.format(i) for i in range(n)]
+    column, names_column, strings_column = Column(data), Column(names), Column(strings)
+    cases = [
+        ('[n for n in mylist if n > 0]', lambda: [x for x in data if x > 0],
+         lambda: column[column > 0].tolist()),
+        ('[n if n > 0 else 0 for n ...]', lambda: [x if x > 0 else 0 for x in data],
+         lambda: column.clip(lo=0).tolist()),
+        ('if 0 < n < 100 and not n == 50', lambda: [x for x in data if 0 < x < 100 and not x == 50],
+         lambda: column[(column > 0) & (column < 100) & ~(column == 50)].tolist()),
+        ('list(filter(is_int, values))', lambda: list(filter(is_int, strings)),
+         lambda: strings_column[is_int_mask(strings)].tolist()),
+        ('compress(names, [n > 5 ...])', lambda: list(compress(names, [x > 5 for x in data])),
+         lambda: names_column[column > 5].tolist()),
+    ]
+    print('{:,} rows, {}'.format(n, 'NumPy' if np is not None else 'no NumPy'))
+    for label, comprehension, masked in cases:
+        start = time.perf_counter()
+        expected = comprehension()
+        t_comp = time.perf_counter() - start
+        start = time.perf_counter()
+        result = masked()
+        t_mask = time.perf_counter() - start
+        print('{:<32}: {:.3f}s, masks {:.3f}s  {:.1f}x  {}'.format(
+            label, t_comp, t_mask, t_comp / t_mask, result == expected))
+
 
 # 1.17 Extracting a Subset of a Dictionary
 prices = {
@@ -611,6 +4040,198 @@ print(s)
 s = s._replace(shares=75) # namedtuple() 값 변경 방법
 print(s)
 
+# Millions of records: a struct-of-arrays table
+# A list of Stock tuples costs a tuple plus an int and a float object for every row.
+# record_table() is declared like namedtuple(), but the class it makes stores each field
+# as one column: ints in array('q'), floats in array('d'), and strings as array('I')
+# codes into a list of distinct strings, so every repeated name is kept once. Indexing a
+# table gives a row view that reads its fields from the columns, and sum_product() does
+# the compute_cost() loop over two whole columns at once.
+class _RowView:
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        table, index = self._table, self._index
+        return (table._value(i, index) for i in range(len(self._fields)))
+
+    def __getitem__(self, i):
+        return tuple(self)[i]
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    __hash__ = None
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, value) for name, value in zip(self._fields, self)))
+
+def _field(i):
+    return property(lambda self: self._table._value(i, self._index))
+
+class RecordTable:
+    _fields = ()
+    _types = ()
+    _row = _RowView
+    _typecodes = {int: 'q', float: 'd', str: 'I'}
+
+    def __init__(self, rows=()):
+        self._columns = [array(self._typecodes[type_]) if type_ in self._typecodes else []
+                         for type_ in self._types]
+        # One code per distinct string, handed out in order by the defaultdict itself
+        self._codes = {}
+        self._strings = {}
+        for i, type_ in enumerate(self._types):
+            if type_ is str:
+                codes = self._codes[i] = defaultdict()
+                codes.default_factory = codes.__len__
+                self._strings[i] = []
+        self.extend(rows)
+
+    def __len__(self):
+        return len(self._columns[0]) if self._columns else 0
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('table index out of range')
+        return self._row(self, index)
+
+    def __iter__(self):
+        return map(self._row, repeat(self), range(len(self)))
+
+    def append(self, row):
+        self.extend([row])
+
+    def extend(self, rows, chunksize=100000):
+        width = len(self._fields)
+        it = iter(rows)
+        while True:
+            chunk = list(islice(it, chunksize))
+            if not chunk:
+                return
+            if set(map(len, chunk)) != {width}:
+                row = next(row for row in chunk if len(row) != width)
+                raise ValueError('Expected {} fields, got {!r}'.format(width, row))
+            # Convert the whole chunk before touching the table, so that a bad value
+            # leaves every column (and the string codes) as they were
+            marks = {i: len(codes) for i, codes in self._codes.items()}
+            try:
+                converted = []
+                for i, values in enumerate(zip(*chunk)):    # Rows to columns, in C
+                    if i in self._codes:
+                        values = map(self._codes[i].__getitem__, values)
+                    column = self._columns[i]
+                    converted.append(array(column.typecode, values) if isinstance(column, array)
+                                     else list(values))
+            except Exception:
+                for i, mark in marks.items():
+                    codes = self._codes[i]
+                    while len(codes) > mark:
+                        codes.popitem()         # The newest codes come off first
+                raise
+            for column, values in zip(self._columns, converted):
+                column.extend(values)
+
+    def _value(self, i, index):
+        value = self._columns[i][index]
+        if i in self._codes:
+            strings = self._strings[i]
+            if value >= len(strings):               # Strings added since the last read
+                strings.extend(islice(self._codes[i], len(strings), None))
+            value = strings[value]
+        return value
+
+    def column(self, name):
+        '''The column for field name: a typed array, or a list of strings'''
+        i = self._fields.index(name)
+        if i in self._codes:
+            strings = list(self._codes[i])
+            return [strings[code] for code in self._columns[i]]
+        return self._columns[i]
+
+    def sum_product(self, a, b):
+        '''sum(row.a * row.b for row in table), over the two columns at once'''
+        x = self._columns[self._fields.index(a)]
+        y = self._columns[self._fields.index(b)]
+        if np is not None and isinstance(x, array) and isinstance(y, array):
+            return float(np.dot(np.frombuffer(x, dtype=x.typecode), np.frombuffer(y, dtype=y.typecode)))
+        return math.fsum(map(operator.mul, x, y))
+
+    def nbytes(self):
+        size = 0
+        for column in self._columns:
+            size += sys.getsizeof(column)
+        for codes in self._codes.values():
+            size += sys.getsizeof(codes)
+            for string in codes:
+                size += sys.getsizeof(string)
+        return size
+
+def record_table(typename, field_names, types):
+    '''Make a RecordTable subclass whose rows look like namedtuple(typename, field_names)'''
+    if isinstance(field_names, str):
+        field_names = field_names.replace(',', ' ').split()
+    fields, types = tuple(field_names), tuple(types)
+    if len(fields) != len(types):
+        raise ValueError('Need one type for each of {}'.format(fields))
+    namespace = {'__slots__': (), '_fields': fields}
+    for i, name in enumerate(fields):
+        namespace[name] = _field(i)
+    row = type(typename, (_RowView,), namespace)
+    return type(typename + 'Table', (RecordTable,), {'_fields': fields, '_types': types, '_row': row})
+
+StockTable = record_table('Stock', ['name', 'shares', 'price'], [str, int, float])
+table = StockTable([('ACME', 100, 123.45), ('AAPL', 50, 612.78)])
+table.append(('ACME', 75, 124.0))
+print(table[0], table[-1].shares, len(table))
+print(table.sum_product('shares', 'price'), compute_cost([('ACME', 100, 123.45), ('AAPL', 50, 612.78),
+                                                           ('ACME', 75, 124.0)]))
+
+@benchmark(n=200000)
+def bench_record_table(n=1000000):
+    import random
+    import tracemalloc
+    random.seed(0)
+    names = ['SYM{}'.format(i) for i in range(500)]
+    Position = namedtuple('Position', ['name', 'shares', 'price'])
+    def records():
+        return ((random.choice(names), random.randrange(1, 1000), random.uniform(1, 1000)) for _ in range(n))
+    tracemalloc.start()
+    stocks = [Position(*rec) for rec in records()]
+    m_tuples = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    positions = record_table('Position', ['name', 'shares', 'price'], [str, int, float])(records())
+    m_table = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('{:,} rows: namedtuple list {:.1f} bytes/row, record table {:.1f} bytes/row'.format(
+        n, m_tuples / n, m_table / n))
+
+    positions = record_table('Position', ['name', 'shares', 'price'], [str, int, float])(stocks)
+    start = time.perf_counter()
+    total = 0.0
+    for rec in stocks:                          # compute_cost() from above
+        s = Position(*rec)
+        total += s.shares * s.price
+    t_loop = time.perf_counter() - start
+    start = time.perf_counter()
+    cost = positions.sum_product('shares', 'price')
+    t_table = time.perf_counter() - start
+    print('compute_cost() loop {:.3f}s, sum_product() {:.3f}s  {}'.format(
+        t_loop, t_table, math.isclose(total, cost)))
+
 
 from collections import namedtuple
 Stock = namedtuple('Stock', ['name', 'shares', 'price', 'date', 'time'])
@@ -626,6 +4247,111 @@ print(stock_prototype)
 b = {'name': 'ACME', 'shares': 100, 'price': 123.45, 'date': '12/17/2012'}
 print(dict_to_stock(b))
 
+# Converting many dicts: one compiled constructor per set of keys
+# _replace(**s) unpacks the dict into keyword arguments and copies the prototype for
+# every row. RecordConverter compiles a small function the first time it sees a given
+# tuple of keys, the way namedtuple() compiles __new__: it reads the fields that are
+# present with d['name'] and passes the defaults for the missing ones as constants,
+# positionally, straight to tuple.__new__. Later dicts with the same keys are converted
+# by a dict lookup and one call.
+ConverterInfo = namedtuple('ConverterInfo', ['hits', 'misses', 'currsize'])
+
+class RecordConverter:
+    def __init__(self, record_type, defaults=None):
+        self.record_type = record_type
+        self.fields = tuple(record_type._fields)
+        self.defaults = dict(getattr(record_type, '_field_defaults', {}))
+        if defaults is not None:
+            self.defaults.update(defaults._asdict() if hasattr(defaults, '_asdict') else defaults)
+        self._cache = {}
+        self.hits = self.misses = 0
+
+    def _compile(self, keys):
+        unexpected = set(keys) - set(self.fields)
+        if unexpected:
+            raise ValueError('Got unexpected field names: {!r}'.format(sorted(unexpected)))
+        namespace = {'_cls': self.record_type}
+        args = []
+        for i, field in enumerate(self.fields):
+            if field in keys:
+                args.append('d[{!r}]'.format(field))
+            elif field in self.defaults:
+                namespace['_default{}'.format(i)] = self.defaults[field]
+                args.append('_default{}'.format(i))
+            else:
+                raise TypeError('Missing field {!r} with no default'.format(field))
+        if issubclass(self.record_type, tuple):
+            namespace['_new'] = tuple.__new__
+            source = 'def convert(d):\n    return _new(_cls, ({},))'.format(', '.join(args))
+        else:
+            source = 'def convert(d):\n    return _cls({})'.format(', '.join(args))
+        exec(source, namespace)
+        self.misses += 1
+        convert = self._cache[keys] = namespace['convert']
+        return convert
+
+    def __call__(self, d):
+        keys = tuple(d)
+        convert = self._cache.get(keys)
+        if convert is None:
+            convert = self._compile(keys)
+        else:
+            self.hits += 1
+        return convert(d)
+
+    convert = __call__
+
+    def convert_many(self, dicts):
+        cache = self._cache
+        hits = 0
+        records = []
+        for d in dicts:
+            convert = cache.get(tuple(d))
+            if convert is None:
+                convert = self._compile(tuple(d))
+            else:
+                hits += 1
+            records.append(convert(d))
+        self.hits += hits
+        return records
+
+    def cache_info(self):
+        return ConverterInfo(self.hits, self.misses, len(self._cache))
+
+to_stock = RecordConverter(Stock, stock_prototype)
+print(to_stock(a), to_stock(b), to_stock({'shares': 50, 'name': 'IBM', 'price': 91.1}))
+print(to_stock.convert_many([a, b, a]) == [dict_to_stock(a), dict_to_stock(b), dict_to_stock(a)])
+print(to_stock.cache_info())
+
+@benchmark(n=200000)
+def bench_record_converter(n=1000000):
+    import random
+    random.seed(0)
+    optional = ['date', 'time']
+    dicts = []
+    for _ in range(n):
+        d = {'name': random.choice(['ACME', 'IBM', 'AAPL']), 'shares': random.randrange(1000),
+             'price': random.uniform(1, 1000)}
+        for field in optional:
+            if random.random() < 0.5:
+                d[field] = '12/17/2012' if field == 'date' else '9:30am'
+        dicts.append(d)
+    start = time.perf_counter()
+    expected = [dict_to_stock(d) for d in dicts]
+    t_replace = time.perf_counter() - start
+    converter = RecordConverter(Stock, stock_prototype)
+    start = time.perf_counter()
+    result = [converter(d) for d in dicts]
+    t_call = time.perf_counter() - start
+    converter = RecordConverter(Stock, stock_prototype)
+    start = time.perf_counter()
+    batch = converter.convert_many(dicts)
+    t_many = time.perf_counter() - start
+    print('{:,} dicts'.format(n))
+    print('_replace(**d)  : {:.3f}s'.format(t_replace))
+    print('converter(d)   : {:.3f}s  {}'.format(t_call, result == expected))
+    print('convert_many() : {:.3f}s  {}  {}'.format(t_many, batch == expected, converter.cache_info()))
+
 
 # 1.19 Transforming and Reducing Data at the Same Time
 nums = [1, 2, 3, 4, 5]
@@ -670,6 +4396,182 @@ print(min_share)
 min_share = min(portfolio, key=lambda s: s['shares']) # Alternative: Returns {'name':'AOL', 'shares':20}
 print(min_share)
 
+# Many reductions in one pass: Reducer
+# Each sum(), min() and max() above makes its own pass, which a generator or a file
+# doesn't allow. Reducer.update() reads its input once, in chunks of a few thousand
+# items, and folds every chunk into count, sum, min/argmin, max/argmax, mean, variance,
+# an fsum() total and any user-defined folds, using C-level builtins on the chunk. The
+# mean and variance of a chunk are combined with the running ones by Chan's update of
+# Welford's method, and the fsum() total is carried as a (high, low) pair of floats with
+# the chunk added to both, so they stay accurate however the input is split. That same merge makes reducers built
+# on separate chunks or in worker processes combine with +. A NumPy array is reduced
+# with NumPy's own sum(), argmin() and so on.
+from functools import reduce
+
+class Reducer:
+    def __init__(self, key=None, chunksize=4096, **folds):
+        # folds: name=(function(acc, value), initial) or (function, initial, merge(acc, acc))
+        self.key = key
+        self.chunksize = chunksize
+        self.folds = folds
+        self.count = 0
+        self.total = 0
+        self._fsum = (0.0, 0.0)
+        self.min = self.argmin = self.max = self.argmax = None
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.results = {name: fold[1] for name, fold in folds.items()}
+
+    def update(self, iterable):
+        '''Add the items; they, or key(item) for each, must be numbers'''
+        if np is not None and isinstance(iterable, np.ndarray) and self.key is None:
+            if iterable.dtype.kind not in 'biuf':
+                raise TypeError('Reducer needs numbers, not a {} array'.format(iterable.dtype))
+            self._update_array(iterable)
+            return self
+        it = iter(iterable)
+        while True:
+            items = list(islice(it, self.chunksize))
+            if not items:
+                return self
+            n = len(items)
+            if self.key is None:
+                values = items
+                low, high = min(values), max(values)
+                argmin, argmax = low, high
+            else:
+                values = list(map(self.key, items))
+                low, high = min(values), max(values)
+                argmin, argmax = items[values.index(low)], items[values.index(high)]
+            try:
+                mean = math.fsum(values) / n
+            except TypeError:
+                raise TypeError('Reducer needs numbers' + (', pass key= to get one from each item'
+                                if self.key is None else ', not what key() returned')) from None
+            deviations = list(map(operator.sub, values, repeat(mean)))
+            m2 = math.fsum(map(operator.mul, deviations, deviations))
+            self._combine(n, reduce(operator.add, values), values, mean, m2, low, argmin, high, argmax)
+            for name, fold in self.folds.items():
+                self.results[name] = reduce(fold[0], values, self.results[name])
+
+    def _update_array(self, values):
+        n = len(values)
+        if not n:
+            return
+        lo, hi = int(values.argmin()), int(values.argmax())
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        self._combine(n, values.sum().item(), values, mean, m2,
+                      values[lo].item(), values[lo].item(), values[hi].item(), values[hi].item())
+        for name, fold in self.folds.items():
+            self.results[name] = reduce(fold[0], values.tolist(), self.results[name])
+
+    def _combine(self, n, total, addends, mean, m2, low, argmin, high, argmax):
+        # Strict comparisons keep the first of equal extremes, like min() and max()
+        if self.count == 0 or low < self.min:
+            self.min, self.argmin = low, argmin
+        if self.count == 0 or high > self.max:
+            self.max, self.argmax = high, argmax
+        count = self.count + n
+        delta = mean - self.mean
+        self._m2 += m2 + delta * delta * self.count * n / count
+        self.mean += delta * n / count
+        self.count = count
+        self.total += total
+        # What fsum() leaves out of high is kept in low, so no chunk is rounded on its own
+        high = math.fsum(chain(self._fsum, addends))
+        self._fsum = (high, math.fsum(chain(self._fsum, addends, (-high,))))
+
+    @property
+    def fsum(self):
+        return math.fsum(self._fsum)
+
+    @property
+    def variance(self):
+        '''Sample variance, as statistics.variance()'''
+        return self._m2 / (self.count - 1) if self.count > 1 else float('nan')
+
+    @property
+    def pvariance(self):
+        return self._m2 / self.count if self.count else float('nan')
+
+    def merge(self, other):
+        '''Fold another Reducer, which saw different items, into this one'''
+        for name, fold in self.folds.items():    # Before anything is changed
+            if len(fold) < 3:
+                raise TypeError('Fold {!r} has no merge function'.format(name))
+        if other.count:
+            self._combine(other.count, other.total, other._fsum, other.mean, other._m2,
+                          other.min, other.argmin, other.max, other.argmax)
+        for name, fold in self.folds.items():
+            self.results[name] = fold[2](self.results[name], other.results[name])
+        return self
+
+    def __add__(self, other):
+        result = Reducer(self.key, self.chunksize, **self.folds)
+        return result.merge(self).merge(other)
+
+    def __repr__(self):
+        return ('Reducer(count={}, total={!r}, min={!r}, max={!r}, mean={!r}, variance={!r})'
+                .format(self.count, self.total, self.min, self.max, self.mean, self.variance))
+
+def reduce_chunk(chunk, key=None):
+    return Reducer(key).update(chunk)
+
+def parallel_reduce(chunks, key=None, workers=None):
+    '''Reduce each chunk in a worker process and merge the results'''
+    total = Reducer(key)
+    with ProcessPoolExecutor(workers) as pool:
+        for part in pool.map(reduce_chunk, chunks, repeat(key)):
+            total.merge(part)
+    return total
+
+r = Reducer()
+r.update(x * x for x in nums)
+print(r.total, r.min, r.max, r.mean, r.variance)
+r = Reducer(key=itemgetter('shares'), names=(lambda acc, shares: acc + 1, 0, operator.add))
+r.update(iter(portfolio))
+print(r.min, r.argmin, r.max, r.argmax, r.results)
+print((Reducer().update([1, 2]) + Reducer().update([3.5, 4])).fsum)
+
+if __name__ == '__main__':
+    print(parallel_reduce([portfolio[:2], portfolio[2:]], key=itemgetter('shares'), workers=2))
+
+@benchmark(n=200000)
+def bench_reducer(n=1000000):
+    import random
+    import statistics
+    random.seed(0)
+    data = [random.gauss(100, 15) for _ in range(n)]
+    start = time.perf_counter()
+    expected = (math.fsum(data), min(data), max(data), statistics.fmean(data), statistics.variance(data))
+    t_passes = time.perf_counter() - start
+    start = time.perf_counter()
+    count, total, mean, m2, lo, hi = 0, 0.0, 0.0, 0.0, math.inf, -math.inf
+    for x in iter(data):                        # One pass, item by item
+        count += 1
+        total += x
+        delta = x - mean
+        mean += delta / count
+        m2 += delta * (x - mean)
+        lo = x if x < lo else lo
+        hi = x if x > hi else hi
+    t_loop = time.perf_counter() - start
+    start = time.perf_counter()
+    r = Reducer().update(iter(data))
+    t_reducer = time.perf_counter() - start
+    same = (r.fsum == expected[0] and (r.min, r.max) == expected[1:3] and
+            math.isclose(r.mean, expected[3]) and math.isclose(r.variance, expected[4]))
+    print('{:,} values'.format(n))
+    print('separate passes (needs a list) : {:.3f}s'.format(t_passes))
+    print('one pass, Python loop          : {:.3f}s'.format(t_loop))
+    print('one pass, Reducer              : {:.3f}s  {}'.format(t_reducer, same))
+    if np is not None:
+        values = np.array(data)
+        start = time.perf_counter()
+        r = Reducer().update(values)
+        print('Reducer on a NumPy array       : {:.3f}s'.format(time.perf_counter() - start))
+
 
 # 1.20 Combining Multiple Mappings into a Single Mapping
 
@@ -711,6 +4613,190 @@ for key, value in values.items():
     print(key, value)
 print(list((key, values[key]) for key in values.keys()))
 
+# Deep scope stacks: FlatChainMap
+# A ChainMap lookup tries each mapping in turn, so a name defined at the bottom of 200
+# scopes (or not defined at all) costs 200 dict lookups. FlatChainMap keeps one dict
+# with the visible value of every key, built on the first lookup, so a lookup is one
+# dict lookup whatever the depth. Writes and deletes through any FlatChainMap go to its
+# first mapping as in ChainMap; its own cache is updated in place, and every other map
+# of the same family (made by new_child() or parents) that contains that mapping only
+# marks the one key as stale, to be looked up again through its maps when next asked.
+# new_child() with no new keys shares the parent's cache, which is copied the first
+# time either map writes to it. Changing a mapping directly, as with a['x'] = 42 above,
+# can't be seen: call invalidate() afterwards. The family's registry only holds weak
+# references, and a mapping's entry goes away with the last map that contains it.
+import weakref
+
+_missing = object()
+
+def _unregister(registry, map_id, keys):
+    for key in keys:
+        members = registry.get(key)
+        if members is not None:
+            members.pop(map_id, None)
+            if not members:
+                del registry[key]
+
+class FlatChainMap(MutableMapping):
+    def __init__(self, *maps, _registry=None):
+        self.maps = list(maps) or [{}]
+        self._flat = None                       # Visible value of every key, built lazily
+        self._stale = set()                     # Keys to look up again through self.maps
+        self._shared = False                    # _flat is shared, copy it before writing
+        self._parent = None
+        # id(mapping) -> {id(map): map} for the FlatChainMaps of the family that contain it
+        self._registry = _registry if _registry is not None else {}
+        for m in self.maps:
+            self._registry.setdefault(id(m), weakref.WeakValueDictionary())[id(self)] = self
+        # Mappings can't be weakly referenced (a dict can't), so the entries are dropped
+        # when this map goes; while it lives, so do its mappings and their ids
+        weakref.finalize(self, _unregister, self._registry, id(self),
+                         [id(m) for m in self.maps]).atexit = False
+
+    def _build(self):
+        flat = {}
+        for m in reversed(self.maps):
+            flat.update(m)
+        self._flat = flat
+        self._stale.clear()
+        self._shared = False
+        return flat
+
+    def _own(self):
+        if self._shared:
+            self._flat = dict(self._flat)
+            self._shared = False
+
+    def _refresh(self, key):
+        self._stale.discard(key)
+        self._own()
+        for m in self.maps:
+            if key in m:
+                value = self._flat[key] = m[key]
+                return value
+        self._flat.pop(key, None)
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        flat = self._flat
+        if flat is None:
+            flat = self._build()
+        if self._stale and key in self._stale:
+            return self._refresh(key)
+        return flat[key]
+
+    def get(self, key, default=None):
+        flat = self._flat
+        if flat is None:
+            flat = self._build()
+        if self._stale and key in self._stale:
+            try:
+                return self._refresh(key)
+            except KeyError:
+                return default
+        return flat.get(key, default)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def _flatten(self):
+        if self._flat is None:
+            self._build()
+        for key in list(self._stale):
+            try:
+                self._refresh(key)
+            except KeyError:
+                pass
+        return self._flat
+
+    def __len__(self):
+        return len(self._flatten())
+
+    def __iter__(self):
+        return iter(list(self._flatten()))
+
+    def _touch(self, key):
+        # The first mapping changed at key: mark it stale in every other map that has it
+        for other in self._registry[id(self.maps[0])].values():
+            if other is not self and other._flat is not None:
+                other._stale.add(key)
+
+    def __setitem__(self, key, value):
+        self.maps[0][key] = value
+        self._touch(key)
+        if self._flat is not None:
+            self._own()
+            self._flat[key] = value
+            self._stale.discard(key)
+
+    def __delitem__(self, key):
+        try:
+            del self.maps[0][key]
+        except KeyError:
+            raise KeyError('Key not found in the first mapping: {!r}'.format(key))
+        self._touch(key)
+        if self._flat is not None:
+            self._stale.add(key)
+
+    def invalidate(self):
+        '''Forget the cache, after a mapping was changed other than through a FlatChainMap'''
+        self._flat = None
+        self._stale.clear()
+
+    def new_child(self, m=None):
+        child = FlatChainMap({} if m is None else m, *self.maps, _registry=self._registry)
+        child._parent = self
+        if self._flat is not None and not child.maps[0]:
+            child._flat = self._flat
+            child._stale = set(self._stale)
+            child._shared = self._shared = True
+        return child
+
+    @property
+    def parents(self):
+        parent = self._parent
+        if parent is not None and len(parent.maps) == len(self.maps) - 1 and \
+                all(a is b for a, b in zip(parent.maps, self.maps[1:])):
+            return parent
+        return FlatChainMap(*self.maps[1:], _registry=self._registry)
+
+    def __repr__(self):
+        return 'FlatChainMap({})'.format(', '.join(map(repr, self.maps)))
+
+values = FlatChainMap()
+values['x'] = 1
+values = values.new_child()
+values['x'] = 2
+values = values.new_child()
+values['x'] = 3
+print(values['x'], values.parents['x'], values.parents.parents['x'])
+del values['x']
+print(values['x'], values)
+values = values.parents
+values['x'] = 20
+print(values['x'], values.parents['x'])
+
+@benchmark()
+def bench_flat_chain_map(depths=(2, 10, 50, 200), keys_per_map=10, lookups=100000):
+    import random
+    random.seed(0)
+    print('{:>6} {:>14} {:>14} {:>14} {:>14}'.format('depth', 'ChainMap hit', 'Flat hit',
+                                                     'ChainMap miss', 'Flat miss'))
+    for depth in depths:
+        maps = [{'k{}_{}'.format(level, i): i for i in range(keys_per_map)} for level in range(depth)]
+        chain_map, flat_map = ChainMap(*maps), FlatChainMap(*maps)
+        deep = ['k{}_{}'.format(depth - 1, random.randrange(keys_per_map)) for _ in range(lookups)]
+        missing = ['missing{}'.format(i % 100) for i in range(lookups)]
+        times = []
+        for keys in (deep, missing):
+            for m in (chain_map, flat_map):
+                get = m.get
+                start = time.perf_counter()
+                for key in keys:
+                    get(key)
+                times.append((time.perf_counter() - start) / lookups * 1e9)
+        print('{:>6} {:>11.0f} ns {:>11.0f} ns {:>11.0f} ns {:>11.0f} ns'.format(depth, *times))
+
 # update() in dict()
 a = {'x':1, 'z':3}
 b = {'y':2, 'z':4}
@@ -742,8 +4828,17 @@ print('b: ', b)
 print(merged)
 
 
-
-
-
-
-
+# Benchmarks
+# Each bench_*() above times one of the additions against the recipe it extends, and is
+# registered by @benchmark with the sizes for a quick run. They build large inputs, start
+# process pools and write temporary files, so they only run on request:
+#   python "1-DataStructures and Algorithms.py" --bench [name ...]
+# where a name is the part after bench_ (e.g. --bench top timer_wheel). No name runs all.
+def run_benchmarks(names=()):
+    for bench, kwargs in BENCHMARKS:
+        if not names or bench.__name__[len('bench_'):] in names:
+            print('==', bench.__name__)
+            bench(**kwargs)
+
+if __name__ == '__main__' and '--bench' in sys.argv:
+    run_benchmarks(sys.argv[sys.argv.index('--bench') + 1:])